@@ -0,0 +1,85 @@
+'''
+Benchmarks record reading: the TransactionReader-based scan loop that
+RecordReader used to run, against RecordReader and MappedRecordReader.
+
+Usage:
+    python bench/bench_records.py [record_count] [record_size]
+'''
+
+import sys
+import time
+import cPickle
+import tempfile
+
+from functools import partial
+
+from vtil.randomtools import random_string
+from vtil.records import RecordWriter, RecordReader, MappedRecordReader
+from vtil.records import DumpedData, find_sentinel, fix_read, _HashFail
+from vtil.transaction import TransactionReader
+
+def transaction_record_reader(stream, tolerate_pre_error=True, tolerate_subsequent_error=False):
+    ' The previous RecordReader scan loop '
+    got_first = False
+    reader = TransactionReader(stream)
+    while True:
+        while True:
+            with reader:
+                block = reader.read(32 * 2**10)
+                if not block:
+                    return
+                match = find_sentinel(block)
+                if not match:
+                    DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
+                    reader.commit()
+                else:
+                    if match.start() > 0:
+                        DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
+                    reader.commit(match.end())
+                    break
+        with reader:
+            try:
+                length = cPickle.load(reader)
+                data = reader.read(length)
+                data_hash = cPickle.load(reader)
+                if data_hash != hash(data) or length != len(data):
+                    raise _HashFail
+                data = fix_read(data)
+                reader.commit()
+                got_first = True
+                yield data
+            except (EOFError, cPickle.UnpicklingError, _HashFail):
+                DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
+
+def bench(name, reader, tf, size, expected_count):
+    tf.seek(0)
+    start = time.time()
+    count = sum(1 for _ in reader(tf))
+    elapsed = time.time() - start
+    assert count == expected_count, (name, count)
+    print '%-30s %8.3fs %10.2f MB/s' % (name, elapsed, size / elapsed / 2**20)
+
+def write_file(record_count, record_size, version):
+    tf = tempfile.TemporaryFile()
+    samples = [random_string(record_size, punctuation=True) for _ in xrange(100)]
+    for i in xrange(record_count):
+        with RecordWriter(tf, version=version) as r:
+            r.write(samples[i % len(samples)])
+    tf.flush()
+    return tf, tf.tell()
+
+def main(record_count=20000, record_size=200):
+    tf, size = write_file(record_count, record_size, 1)
+    print '%d version 1 records, %d bytes' % (record_count, size)
+    bench('TransactionReader scan loop', transaction_record_reader, tf, size, record_count)
+    bench('RecordReader', RecordReader, tf, size, record_count)
+    bench('MappedRecordReader', MappedRecordReader, tf, size, record_count)
+
+    tf, size = write_file(record_count, record_size, 2)
+    print '%d version 2 records, %d bytes' % (record_count, size)
+    bench('RecordReader', RecordReader, tf, size, record_count)
+    bench('MappedRecordReader', MappedRecordReader, tf, size, record_count)
+    bench('MappedRecordReader, no copy', partial(MappedRecordReader, copy=False), tf, size, record_count)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -11,23 +11,42 @@ import tempfile
 import sys
 import random
 import cPickle
+import asyncore
+import socket
+import time
+import threading
+import itertools
+import operator
+import weakref
 
 from operator import itemgetter
 from types import NotImplementedType
+from multiprocessing.pool import MaybeEncodingError
 from cStringIO import StringIO
 
 import vtil
 
 from vtil import randomtools
-from vtil.counter import Counter
-from vtil.sorting import is_sorted, sortingPipe, extsorted
-from vtil.indexed import IndexedKVWriter, IndexedKVReader, IndexNotLoaded
-from vtil.rangereader import RangeReader
+from vtil import accum
+from vtil.counter import Counter, TopKCounter, SpillingCounter
+from vtil.sorting import is_sorted, sortingPipe, extsorted, DEFAULT_MAX_MEM
+from vtil.indexed import IndexedKVWriter, IndexedKVReader, IndexNotLoaded, write_sorted_kv
+from vtil.rangereader import RangeReader, split_ranges
 from vtil.records import RecordWriter, RecordReader, RecordReadError, SENTINEL
+from vtil.records import RecordIndex, IndexedRecordReader, build_index
+from vtil.records import RecordBlockWriter, RecordScanner, MappedRecordReader, RangeRecordReader, ParallelRecordReader
 from vtil.transaction import TransactionReader, TransactionWriter
 from vtil.randomtools import random_string
-from vtil.partition import Partitioner, StringPartitioner, HashPartitioner, NumberPartitioner
-from vtil.iterator import wrap_around, pairwise
+from vtil.partition import Partitioner, StringPartitioner, HashPartitioner, NumberPartitioner, RangePartitioner
+from vtil.partition import group_indices, stable_hash, StableHashPartitioner, JumpHashPartitioner
+from vtil.iterator import wrap_around, pairwise, threaded, processed, parallel_map
+from vtil.diskbuffered import DiskBufferedOutput
+from vtil.asyncrecords import RecordChannel, RecordServer
+from vtil.threadpool import ThreadPool, CancelledError
+from vtil.processpool import ProcessPool
+from vtil.shuffle import ShuffleWriter, read_bucket, FORMATS
+from vtil.mapreduce import MapReduce
+from vtil.join import groupby_sorted, merge_join, SpilledGroup, hash_aggregate, hash_join
 
 class UtilTest(unittest.TestCase):
     def test_fixed_int(self):
@@ -35,6 +54,74 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(s, vtil.fixed_int(int(s), len(s)))
         self.assertRaises(ValueError, vtil.fixed_int, int(s), 1)
 
+def _failing_producer(n):
+    for i in xrange(n):
+        yield i
+    raise KeyError('producer')
+
+def _dying_producer(n):
+    for i in xrange(n):
+        yield i
+    os._exit(3)
+
+class _UnpicklableError(Exception):
+    def __reduce__(self):
+        raise TypeError('not picklable')
+
+def _raise_unpicklable(x):
+    raise _UnpicklableError()
+
+def _unpicklable_result(x):
+    return _UnpicklableError()
+
+def _unpicklable_failing_producer():
+    yield 1
+    raise _UnpicklableError()
+
+def _square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+def _square_or_die(x):
+    if x < 0:
+        os._exit(2)
+    if x == 0:
+        raise KeyboardInterrupt
+    return x * x
+
+def _reversed_string(s):
+    return s[::-1]
+
+def _word_mapper(line):
+    for word in line.split():
+        yield word, 1
+
+def _failing_mapper(line):
+    raise KeyError(line)
+
+def _dying_mapper(line):
+    os._exit(4)
+
+def _dying_reducer(word, counts):
+    os._exit(5)
+
+def _dying_range(args):
+    os._exit(9)
+
+def _sum_reducer(word, counts):
+    yield word, sum(counts)
+
+def _sum_combiner(word, counts):
+    yield sum(counts)
+
+class _Item(object):
+    ' A picklable object that can be weakly referenced '
+    def __init__(self, value):
+        self.value = value
+    def __eq__(self, other):
+        return isinstance(other, _Item) and self.value == other.value
+
 class IteratorTest(unittest.TestCase):
     def test_wrap_around(self):
         l = xrange(7)
@@ -52,12 +139,351 @@ class IteratorTest(unittest.TestCase):
         l = xrange(3)
         self.assertEqual([(0,1), (1,2)], [x for x in pairwise(l)])
 
+    def test_threaded_batched(self):
+        l = range(10000)
+        self.assertEqual(l, list(threaded(l, batch_size=64)))
+        self.assertEqual(l, list(threaded(l, max_count=2, batch_size=100)))
+        self.assertEqual(l, list(threaded(l, max_mem=1024, batch_size=100)))
+        self.assertEqual([], list(threaded([], batch_size=10)))
+
+        def failing():
+            yield 1
+            yield 2
+            raise KeyError('producer')
+        g = threaded(failing(), batch_size=1)
+        self.assertEqual(1, next(g))
+        self.assertEqual(2, next(g))
+        self.assertRaises(KeyError, next, g)
+
+        # the partial batch before the error is still delivered
+        g = threaded(failing(), batch_size=10)
+        self.assertEqual([1, 2], [next(g) for _ in xrange(2)])
+        self.assertRaises(KeyError, next, g)
+
+        # consumer stops early: the producer must not block forever
+        produced = []
+        def infinite():
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+        g = threaded(infinite(), max_count=1, batch_size=10)
+        self.assertEqual(range(5), [next(g) for _ in xrange(5)])
+        g.close()
+        time.sleep(0.3)
+        count = len(produced)
+        time.sleep(0.3)
+        self.assertEqual(count, len(produced))
+
+    def test_processed(self):
+        l = range(10000)
+        self.assertEqual(l, list(processed(range, (10000,))))
+        self.assertEqual(l, list(processed(xrange, (10000,), max_count=2, batch_size=7)))
+        self.assertEqual(l, list(processed(xrange, (10000,), max_mem=1024, batch_size=100)))
+        self.assertEqual([], list(processed(xrange, (0,))))
+
+        g = processed(_failing_producer, (3,), batch_size=2)
+        self.assertEqual([0, 1, 2], [next(g) for _ in xrange(3)])
+        self.assertRaises(KeyError, next, g)
+
+        # the producer dies, or raises something the queue can't carry
+        # (os._exit() may lose batches still in the queue's feeder thread)
+        self.assertRaises(RuntimeError, list, processed(_dying_producer, (3,), batch_size=2))
+        g = processed(_unpicklable_failing_producer)
+        self.assertEqual(1, next(g))
+        self.assertRaises(RuntimeError, next, g)
+
+        # consumer stops early
+        g = processed(itertools.count, max_count=1, batch_size=10)
+        self.assertEqual(range(5), [next(g) for _ in xrange(5)])
+        g.close()
+
+    def test_parallel_map(self):
+        l = range(1000)
+        expected = [_square(x) for x in l]
+        for backend in ('thread', 'process'):
+            self.assertEqual(expected, list(parallel_map(_square, l, workers=3, backend=backend)))
+            self.assertEqual(expected, list(parallel_map(_square, l, workers=3, chunksize=7,
+                                                         max_inflight=2, backend=backend)))
+            self.assertEqual(sorted(expected), sorted(parallel_map(_square, l, workers=3, chunksize=7,
+                                                                   ordered=False, backend=backend)))
+            for ordered in (True, False):
+                self.assertRaises(ValueError, list,
+                                  parallel_map(_square, [1, 2, -1, 3], workers=2,
+                                               ordered=ordered, backend=backend))
+        # dead workers and unpicklable errors or results raise rather than hang
+        for ordered in (True, False):
+            def pmap(func, values):
+                return list(parallel_map(func, values, workers=2, ordered=ordered, backend='process'))
+            self.assertRaises(RuntimeError, pmap, _square_or_die, [1, 2, -1] + range(1, 20))
+            self.assertRaises(RuntimeError, pmap, _raise_unpicklable, range(5))
+            self.assertRaises(MaybeEncodingError, pmap, _unpicklable_result, range(5))
+
+        # lazy on infinite input
+        g = parallel_map(_square, itertools.count(), workers=2, chunksize=10)
+        self.assertEqual(expected[:50], list(itertools.islice(g, 50)))
+        g.close()
+        self.assertRaises(ValueError, list, parallel_map(_square, l, backend='fork'))
+
+class ThreadPoolTest(unittest.TestCase):
+    def test_push(self):
+        pool = ThreadPool(3, _square, max_queued=100)
+        pool.map(xrange(50), chunksize=8)
+        pool.push(-1)
+        pool.start()
+        pool.join()
+        results = list(pool)
+        errors = [r for r in results if isinstance(r, Exception)]
+        self.assertEqual(1, len(errors))
+        self.assertEqual(sorted(x*x for x in xrange(50)),
+                         sorted(r for r in results if not isinstance(r, Exception)))
+
+    def test_submit(self):
+        pool = ThreadPool(2)
+        pool.start()
+        f = pool.submit(divmod, 7, 2)
+        self.assertEqual((3, 1), f.result())
+        f = pool.submit(_square, -1)
+        self.assertRaises(ValueError, f.result)
+        self.assertTrue(isinstance(f.exception(), ValueError))
+        self.assertTrue(f.done())
+        pool.join()
+
+        f = pool.submit(_square, 2) # no threads left to run it
+        self.assertTrue(f.cancel())
+        self.assertRaises(CancelledError, f.result)
+
+    def test_imap(self):
+        pool = ThreadPool(4, _square, max_queued=3)
+        pool.start()
+        l = range(1000)
+        expected = [x*x for x in l]
+        self.assertEqual(expected, list(pool.imap(l)))
+        self.assertEqual(expected, list(pool.imap(l, window=3, chunksize=16)))
+        self.assertEqual(expected, sorted(pool.imap_unordered(l, window=3, chunksize=16)))
+        self.assertRaises(ValueError, list, pool.imap([1, -1, 2], chunksize=1))
+        self.assertRaises(ValueError, list, pool.imap_unordered([1, -1, 2], chunksize=1))
+        g = pool.imap(itertools.count(), chunksize=10)
+        self.assertEqual(expected[:25], list(itertools.islice(g, 25)))
+        g.close()
+        pool.join()
+
+    def test_stats(self):
+        pool = ThreadPool(2, _square)
+        self.assertRaises(ValueError, pool.stats)
+
+        reports = []
+        pool = ThreadPool(2, time.sleep, stats=True, stats_callback=reports.append,
+                          stats_interval=0.05)
+        pool.map([0.01] * 20, chunksize=2)
+        pool.start()
+        pool.join()
+        stats = pool.stats()
+        self.assertEqual(20, stats['tasks'])
+        self.assertEqual(20, sum(w['tasks'] for w in stats['workers']))
+        self.assertTrue(sum(w['busy'] for w in stats['workers']) >= 0.2)
+        self.assertTrue(0 < stats['utilization'] <= 1)
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertTrue(stats['run']['p50'] >= 0.01)
+        self.assertTrue(stats['run']['p50'] <= stats['run']['p99'] <= stats['run']['max'])
+        self.assertTrue(stats['wait']['max'] >= stats['wait']['p50'] >= 0)
+        self.assertTrue(reports)
+        self.assertEqual(list(pool), [None] * 20)
+
+class ProcessPoolTest(unittest.TestCase):
+    def test_map(self):
+        pool = ProcessPool(3, _square, max_queued=4)
+        pool.start()
+        pool.map(xrange(500), chunksize=16)
+        pool.push(-1)
+        pool.join()
+        results = list(pool)
+        errors = [r for r in results if isinstance(r, Exception)]
+        self.assertEqual(1, len(errors))
+        self.assertTrue(isinstance(errors[0], ValueError))
+        self.assertEqual(sorted(x*x for x in xrange(500)),
+                         sorted(r for r in results if not isinstance(r, Exception)))
+
+    def test_dead_workers(self):
+        # a worker stopped by KeyboardInterrupt still lets join() finish
+        pool = ProcessPool(2, _square_or_die)
+        pool.start()
+        pool.map(xrange(20))
+        pool.join()
+        self.assertTrue(set(pool) <= set(x*x for x in xrange(1, 20)))
+
+        # results computed before the interrupt are kept
+        pool = ProcessPool(1, _square_or_die)
+        pool.start()
+        pool.map([1, 2, 3, 0, 4], chunksize=5)
+        pool.join()
+        self.assertEqual([1, 4, 9], list(pool))
+
+        # a worker that dies makes join() raise rather than hang
+        pool = ProcessPool(2, _square_or_die, max_queued=2)
+        pool.start()
+        pool.map(xrange(1, 20))
+        pool.push(-1)
+        self.assertRaises(RuntimeError, pool.join)
+        self.assertTrue(set(pool) <= set(x*x for x in xrange(1, 20)))
+
+        # exceptions that can't be pickled arrive as RuntimeErrors
+        pool = ProcessPool(2, _raise_unpicklable)
+        pool.start()
+        pool.map(xrange(5), chunksize=2)
+        pool.join()
+        self.assertEqual([RuntimeError] * 5, [type(e) for e in pool])
+
+        # pushing raises once every worker is dead
+        pool = ProcessPool(1, _square_or_die, max_queued=1)
+        pool.start()
+        pool.push(-1)
+        self.assertRaises(RuntimeError, pool.map, xrange(1, 10))
+        self.assertRaises(RuntimeError, pool.join)
+
+    def test_shared(self):
+        data = [random_string(size) for size in (10, 1000, 5000, 0)]
+        pool = ProcessPool(2, _reversed_string, shared_threshold=1000)
+        pool.map(data, chunksize=2)
+        pool.start()
+        pool.join()
+        self.assertEqual(sorted(d[::-1] for d in data), sorted(pool))
+
+class AccumTest(unittest.TestCase):
+    def test_accumulators(self):
+        a = accum.Averager()
+        self.assertEqual(None, a.value)
+        self.assertEqual(4, a(4))
+        self.assertEqual(6, a.update_many([5, 9]))
+        self.assertEqual(6, a.update_many(iter([])))
+        self.assertEqual((18, 3), a.state())
+        self.assertEqual(6, a.value) # state() doesn't change the result
+        self.assertEqual(5.5, a(4))
+
+        s = accum.Summer()
+        s(3)
+        self.assertEqual(13, s.update_many(xrange(5)))
+        c = accum.Counter()
+        c('x')
+        self.assertEqual(4, c.update_many('abc'))
+        self.assertEqual(6, c.update_many(x for x in 'yz'))
+
+    def test_merge(self):
+        values = [random.random() for _ in xrange(1000)]
+        for acc_type, expected in ((accum.Averager, sum(values) / len(values)),
+                                   (accum.Summer, sum(values)),
+                                   (accum.Counter, len(values))):
+            parts = [acc_type() for _ in xrange(4)]
+            for i, part in enumerate(parts):
+                part.update_many(values[i::4])
+            total = acc_type()
+            total.merge(parts[0])
+            for part in parts[1:]:
+                total.merge(cPickle.loads(cPickle.dumps(part.state()))) # e.g. from another process
+            self.assertAlmostEqual(expected, total.value)
+
+    def test_sketches(self):
+        values = [random.gauss(10, 3) for _ in xrange(5000)]
+        mean = sum(values) / len(values)
+        variance = sum((v - mean) ** 2 for v in values) / len(values)
+        q = sorted(values)
+
+        v = accum.Variance()
+        self.assertEqual(None, v.value)
+        [v(x) for x in values[:10]]
+        v.update_many(values[10:])
+        self.assertAlmostEqual(variance, v.value)
+
+        m = accum.MinMax()
+        self.assertEqual((None, None), m.value)
+        m.update_many(values[:100])
+        [m(x) for x in values[100:]]
+        self.assertEqual((q[0], q[-1]), m.value)
+
+        s = accum.QuantileSketch(relative_accuracy=0.01)
+        s.update_many(values)
+        s(0)
+        s(-5)
+        for p in (0.01, 0.5, 0.9, 0.99):
+            exact = sorted(values + [0, -5])[int(p * (len(values) + 1))]
+            self.assertTrue(abs(s.value.quantile(p) - exact) <= 0.011 * abs(exact) + 0.05)
+        self.assertEqual(None, accum.QuantileSketch().value.quantile(0.5))
+        self.assertRaises(ValueError, accum.QuantileSketch, 2)
+
+        h = accum.HyperLogLog(precision=12)
+        self.assertEqual(0, h.value)
+        h.update_many(xrange(20000))
+        h.update_many(xrange(10000)) # duplicates
+        h('x')
+        self.assertTrue(abs(h.value - 20001) < 20001 * 0.05)
+        small = accum.HyperLogLog()
+        small.update_many(['a', 'b', 'c', 'a'])
+        self.assertEqual(3, small.value)
+        self.assertRaises(ValueError, accum.HyperLogLog, 20)
+
+    def test_sketch_merge(self):
+        values = [random.expovariate(1) for _ in xrange(4000)]
+        for acc_type in (accum.Variance, accum.MinMax, accum.QuantileSketch, accum.HyperLogLog):
+            whole = acc_type()
+            whole.update_many(values)
+            parts = [acc_type() for _ in xrange(4)]
+            for i, part in enumerate(parts):
+                part.update_many(values[i::4])
+            merged = acc_type()
+            for part in parts:
+                merged.merge(cPickle.loads(cPickle.dumps(part.state())))
+            if acc_type is accum.QuantileSketch:
+                for p in (0.1, 0.5, 0.99):
+                    self.assertAlmostEqual(whole.value.quantile(p), merged.value.quantile(p))
+            elif acc_type is accum.Variance:
+                self.assertAlmostEqual(whole.value, merged.value)
+            else:
+                self.assertEqual(whole.value, merged.value)
+        self.assertRaises(ValueError, accum.HyperLogLog(4).merge, accum.HyperLogLog(5))
+        self.assertRaises(ValueError, accum.QuantileSketch(0.01).merge, accum.QuantileSketch(0.02))
+
 class CounterTest(unittest.TestCase):
     def test_Counter(self):
         l = [1,1,2,3,5]
         c = Counter(l)
         self.assertEqual([(1,2), (2,1), (3,1), (5,1)], list(c.most_common()))
 
+    def zipf_keys(self, count):
+        return [int(random.paretovariate(1.2)) for _ in xrange(count)]
+
+    def test_top_k_counter(self):
+        keys = self.zipf_keys(20000)
+        exact = Counter(keys)
+        top = TopKCounter(50, keys)
+        self.assertEqual(50, len(top))
+        for key, count in exact.most_common(5):
+            self.assertTrue(key in top)
+            lower, upper = top.bounds(key)
+            self.assertTrue(lower <= count <= upper)
+            self.assertTrue(upper - count <= len(keys) / 50)
+        self.assertEqual([k for k, _ in exact.most_common(3)], [k for k, _ in top.most_common(3)])
+        self.assertRaises(ValueError, TopKCounter, 0)
+
+        # merged counters keep valid bounds
+        halves = TopKCounter(50, keys[:10000]), TopKCounter(50, keys[10000:])
+        halves[0].merge(halves[1])
+        self.assertEqual(len(keys), halves[0].total)
+        for key, count in exact.most_common(5):
+            lower, upper = halves[0].bounds(key)
+            self.assertTrue(lower <= count <= upper)
+
+    def test_spilling_counter(self):
+        keys = self.zipf_keys(5000) + [random_string(5) for _ in xrange(2000)]
+        exact = Counter(keys)
+        for max_mem in (DEFAULT_MAX_MEM, 2000):
+            c = SpillingCounter(keys[:100], max_mem=max_mem)
+            c.update(keys[100:])
+            self.assertEqual(sorted(exact.items()), list(c.iteritems()))
+            self.assertEqual(sorted(exact.values(), reverse=True), [n for _, n in c.most_common()])
+            self.assertEqual([n for _, n in exact.most_common(10)], [n for _, n in c.most_common(10)])
+        self.assertEqual([], list(SpillingCounter().most_common()))
+
 class SortingTest(unittest.TestCase):
     def test_is_sorted(self):
         self.assertTrue(is_sorted([1,2,3,4,5]))
@@ -101,6 +527,42 @@ class PartitionTest(unittest.TestCase):
         self.assertEqual(len(h), 6)
         self.isUniform(h, 0.1)
 
+    def test_stable_hash(self):
+        self.assertEqual(stable_hash('abc'), stable_hash(u'abc'))
+        self.assertEqual(stable_hash(5), stable_hash(5L))
+        self.assertNotEqual(stable_hash('abc'), stable_hash('acb'))
+        self.assertEqual(4385605795741011734, stable_hash('abc')) # must never change
+        self.assertTrue(0 <= stable_hash(random_string(20)) < 2**64)
+        self.assertEqual(stable_hash(1), stable_hash(1.0))
+        self.assertEqual(stable_hash(1), stable_hash(True))
+        self.assertEqual(stable_hash(0), stable_hash(-0.0))
+        self.assertNotEqual(stable_hash(1), stable_hash(1.5))
+        self.assertEqual(stable_hash(('a', 1)), stable_hash((u'a', 1.0)))
+        self.assertNotEqual(stable_hash(('a', 1)), stable_hash((1, 'a')))
+        self.assertNotEqual(stable_hash(('ab', 'c')), stable_hash(('a', 'bc')))
+        self.assertNotEqual(stable_hash(('a',)), stable_hash('a'))
+        self.assertEqual(StableHashPartitioner(7)(('a', (2, 'b'))), StableHashPartitioner(7)(('a', (2L, 'b'))))
+        self.assertRaises(TypeError, stable_hash, ['a', 1])
+        self.assertRaises(TypeError, stable_hash, ('a', None))
+
+    def test_stable_hash_partitioner(self):
+        h = StableHashPartitioner(6)
+        self.assertEqual(len(h), 6)
+        self.isUniform(h, 0.1)
+        self.isUniform(h, 0.1, rfunc=lambda: random.randint(0, 10**9))
+
+    def test_jump_hash_partitioner(self):
+        h = JumpHashPartitioner(6)
+        self.assertEqual(len(h), 6)
+        self.isUniform(h, 0.1)
+
+        keys = [random_string(8) for _ in xrange(10000)]
+        before = map(JumpHashPartitioner(10), keys)
+        after = map(JumpHashPartitioner(11), keys)
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(a == 10 for _, a in moved)) # only to the new bucket
+        self.assertTrue(len(moved) < 10000 * 1.2 / 11)
+
     def test_string_partitioner(self):
         h = StringPartitioner(6)
         self.assertEqual(len(h), 6)
@@ -113,6 +575,216 @@ class PartitionTest(unittest.TestCase):
         self.isUniform(h, 0.1, rfunc = random.random)
         self.assertRaises(ValueError, h.partition, 10**10)
 
+    def test_range_partitioner(self):
+        h = RangePartitioner(['b', 'd', 'd', 'x'])
+        self.assertEqual(5, len(h))
+        self.assertEqual([0, 1, 1, 3, 3, 4], map(h, ['a', 'b', 'c', 'd', 'e', 'z']))
+        self.assertRaises(ValueError, RangePartitioner, [2, 1])
+
+        # skewed keys still give balanced, ordered buckets
+        skewed = lambda: random.random() ** 8
+        h = RangePartitioner.from_sample((skewed() for _ in xrange(100000)), 6)
+        self.assertEqual(6, len(h))
+        self.isUniform(h, 0.2, rfunc=skewed)
+        keys = sorted(skewed() for _ in xrange(1000))
+        self.assertTrue(is_sorted(map(h, keys)))
+
+        h2 = cPickle.loads(cPickle.dumps(h))
+        self.assertEqual(h.splits, h2.splits)
+        self.assertEqual(map(h, keys), map(h2, keys))
+        self.assertRaises(ValueError, RangePartitioner.from_sample, [], 4)
+
+    def test_partition_many(self):
+        keys = [random.random() for _ in xrange(1000)]
+        for h in (NumberPartitioner(0, 1, 6),
+                  RangePartitioner([0.1, 0.2, 0.5]),
+                  RangePartitioner.from_sample(keys, 4)):
+            self.assertEqual(map(h, keys), list(h.partition_many(keys)))
+        words = [random_string(4) for _ in xrange(1000)]
+        for h in (StringPartitioner(6), RangePartitioner(['M', 'a', 'm'])):
+            self.assertEqual(map(h, words), list(h.partition_many(words)))
+        self.assertEqual([], list(NumberPartitioner(0, 1, 6).partition_many([])))
+        self.assertRaises(ValueError, NumberPartitioner(0, 1, 6).partition_many, [0.5, 2])
+
+        buckets = NumberPartitioner(0, 1, 6).partition_many(keys)
+        groups = group_indices(buckets, 6)
+        self.assertEqual(6, len(groups))
+        for bucket, indices in enumerate(groups):
+            self.assertEqual(sorted(i for i, b in enumerate(buckets) if b == bucket), list(indices))
+        self.assertEqual([[], [0, 2], [1]], map(list, group_indices([1, 2, 1], 3)))
+
+    def test_reservoir_sample(self):
+        self.assertEqual([0, 1, 2], sorted(randomtools.reservoir_sample(xrange(3), 5)))
+        sample = randomtools.reservoir_sample(xrange(10000), 100)
+        self.assertEqual(100, len(set(sample)))
+        self.assertTrue(max(sample) > 5000) # not just the first 100
+
+class ShuffleTest(unittest.TestCase):
+    def shuffle(self, pairs, partitioner, **kwargs):
+        files = [StringIO() for _ in xrange(len(partitioner))]
+        with ShuffleWriter(partitioner, files.__getitem__, **kwargs) as writer:
+            writer.write_pairs(pairs[:len(pairs)//2])
+            for key, value in pairs[len(pairs)//2:]:
+                writer.write(key, value)
+        self.assertEqual(len(pairs), sum(writer.counts))
+        fmt = kwargs.get('format', 'records')
+        return [list(read_bucket(StringIO(f.getvalue()), fmt)) for f in files]
+
+    def test_shuffle(self):
+        pairs = [(random.random(), random_string(10)) for _ in xrange(2000)]
+        partitioner = NumberPartitioner(0, 1, 7)
+        for kwargs in (dict(), dict(max_mem=10000), dict(max_mem=10000, sort=True),
+                       dict(max_mem=10000, format='indexed'), dict(format='indexed')):
+            buckets = self.shuffle(pairs, partitioner, **kwargs)
+            self.assertEqual(7, len(buckets))
+            for bucket, bucket_pairs in enumerate(buckets):
+                self.assertTrue(all(partitioner(k) == bucket for k, _ in bucket_pairs))
+                if kwargs.get('sort') or kwargs.get('format') == 'indexed':
+                    self.assertTrue(is_sorted(bucket_pairs, key=itemgetter(0)))
+            self.assertEqual(sorted(pairs), sorted(p for b in buckets for p in b))
+
+        # empty buckets still get valid files
+        buckets = self.shuffle([(0.5, 'x')], partitioner, format='indexed')
+        self.assertEqual([[], [], [], [(0.5, 'x')], [], [], []], buckets)
+        buckets = self.shuffle(pairs, partitioner, sort=True, key=lambda k: -k)
+        self.assertTrue(all(is_sorted(b, key=itemgetter(0), reverse=True) for b in buckets))
+        self.assertRaises(ValueError, ShuffleWriter, partitioner, None, format='csv')
+
+    def test_spills(self):
+        # many buckets, each spilled many times, take one spill file between them
+        pairs = [(random.random(), random_string(10)) for _ in xrange(20000)]
+        partitioner = NumberPartitioner(0, 1, 300)
+        for fmt in FORMATS:
+            files = [StringIO() for _ in xrange(len(partitioner))]
+            fds = os.listdir('/proc/self/fd') if os.path.isdir('/proc/self/fd') else None
+            writer = ShuffleWriter(partitioner, files.__getitem__, max_mem=20000, format=fmt, sort=True)
+            writer.write_pairs(pairs)
+            self.assertTrue(sum(len(runs) for runs in writer._runs) > 600)
+            if fds is not None:
+                self.assertTrue(len(os.listdir('/proc/self/fd')) <= len(fds) + 1)
+            writer.close()
+            buckets = [list(read_bucket(StringIO(f.getvalue()), fmt)) for f in files]
+            self.assertTrue(all(is_sorted(b, key=itemgetter(0)) for b in buckets))
+            self.assertEqual(sorted(pairs), sorted(p for b in buckets for p in b))
+
+    def test_combiner(self):
+        pairs = [(random.randint(0, 9), 1) for _ in xrange(1000)]
+        buckets = self.shuffle(pairs, NumberPartitioner(0, 10, 3), max_mem=2000,
+                               combiner=lambda key, values: [sum(values)])
+        totals = Counter()
+        for key, value in (p for b in buckets for p in b):
+            totals[key] += value
+        self.assertEqual(Counter(k for k, _ in pairs), totals)
+        self.assertTrue(sum(len(b) for b in buckets) < len(pairs))
+
+class MapReduceTest(unittest.TestCase):
+    def test_word_count(self):
+        words = [random_string(2, uppercase=False) for _ in xrange(5000)]
+        lines = [' '.join(words[i:i+10]) for i in xrange(0, len(words), 10)]
+        expected = sorted(Counter(words).items())
+        for combiner in (None, _sum_combiner):
+            with MapReduce(_word_mapper, _sum_reducer, partitions=3, combiner=combiner,
+                           processes=2, max_mem=20000) as job:
+                outputs = job.run(lines, split_size=100)
+                self.assertEqual(3, len(outputs))
+                self.assertEqual(expected, sorted(job.results()))
+                self.assertEqual(2, job.counters['map_tasks'])
+                self.assertEqual(5, job.counters['map_splits'])
+                self.assertEqual(len(expected), job.counters['reduce_output'])
+                if combiner is None:
+                    self.assertEqual(len(words), job.counters['map_output'])
+                self.assertEqual(2, len(job.timings['map_tasks']))
+                self.assertTrue(job.timings['total'] >= job.timings['map'])
+                workdir = job._workdir
+            self.assertFalse(os.path.exists(workdir))
+
+        # one bucket file per map task, however many splits
+        with MapReduce(_word_mapper, _sum_reducer, partitions=2, processes=3) as job:
+            job.run(lines, split_size=10)
+            self.assertEqual(50, job.counters['map_splits'])
+            self.assertEqual(expected, sorted(job.results()))
+            self.assertEqual(2, len(os.listdir(job._workdir))) # buckets removed by reduce
+
+        # map and reduce task failures are raised, not waited on
+        for mapper, reducer, error in ((_failing_mapper, _sum_reducer, KeyError),
+                                       (_dying_mapper, _sum_reducer, RuntimeError),
+                                       (_word_mapper, _dying_reducer, RuntimeError)):
+            with MapReduce(mapper, reducer, processes=2) as job:
+                self.assertRaises(error, job.run, lines, split_size=10)
+
+class JoinTest(unittest.TestCase):
+    def test_groupby_sorted(self):
+        items = sorted(random.randint(0, 20) for _ in xrange(500)) + [30] * 1000
+        groups = list(groupby_sorted(items, max_mem=1000))
+        self.assertEqual(sorted(set(items)), [k for k, _ in groups])
+        for k, group in groups:
+            self.assertEqual([k] * items.count(k), list(group))
+            self.assertEqual(list(group), list(group)) # re-iterable
+        self.assertTrue(isinstance(groups[-1][1], SpilledGroup))
+        self.assertEqual(1000, len(groups[-1][1]))
+        self.assertEqual([], list(groupby_sorted([])))
+        self.assertRaises(ValueError, list, groupby_sorted([1, 2, 1]))
+
+    def test_spilled_group(self):
+        # spilled items are not kept alive, and are stored as they were when appended
+        items = [_Item(i) for i in xrange(10)]
+        refs = [weakref.ref(item) for item in items]
+        group = SpilledGroup(items)
+        item = items[0]
+        del items
+        self.assertEqual([None] * 9, [ref() for ref in refs[1:]])
+        item.value = 'changed'
+        group.append(item)
+        self.assertEqual([_Item(i) for i in xrange(10)] + [item], list(group))
+        self.assertEqual(11, len(group))
+        # appending after a partial iteration
+        group = SpilledGroup(range(5))
+        itr = iter(group)
+        self.assertEqual([0, 1], [next(itr), next(itr)])
+        group.append(99)
+        self.assertEqual([0, 1, 2, 3, 4, 99], list(group))
+        self.assertEqual(6, len(group))
+
+    def test_merge_join(self):
+        left = [(k, 'l%d' % i) for i, k in enumerate([1, 2, 2, 4, 5])]
+        right = [(k, 'r%d' % i) for i, k in enumerate([0, 2, 2, 3, 5])]
+        def join(how, **kwargs):
+            return list(merge_join(left, right, key=itemgetter(0), how=how, **kwargs))
+        inner = [(left[1], right[1]), (left[1], right[2]), (left[2], right[1]),
+                 (left[2], right[2]), (left[4], right[4])]
+        self.assertEqual(inner, join('inner'))
+        self.assertEqual(inner, join('inner', max_mem=1)) # groups spilled
+        self.assertEqual(sorted([(left[0], None), (left[3], None)] + inner), sorted(join('left')))
+        self.assertEqual(sorted([(None, right[0]), (None, right[3])] + inner), sorted(join('right')))
+        self.assertEqual(len(inner) + 4, len(join('outer')))
+        self.assertEqual([], list(merge_join([], right, key=itemgetter(0))))
+        self.assertEqual(len(right), len(list(merge_join([], right, key=itemgetter(0), how='outer'))))
+        self.assertRaises(ValueError, join, 'cross')
+
+        # different keys per side
+        pairs = list(merge_join(xrange(5), ['0', '2', '4'], left_key=str, right_key=str))
+        self.assertEqual([(0, '0'), (2, '2'), (4, '4')], pairs)
+
+    def test_hash_aggregate(self):
+        words = [random_string(3, uppercase=False) for _ in xrange(20000)]
+        expected = sorted(Counter(words).items())
+        for max_mem in (DEFAULT_MAX_MEM, 10000, 100):
+            pairs = ((w, 1) for w in words)
+            self.assertEqual(expected, sorted(hash_aggregate(pairs, operator.add, max_mem=max_mem, fanout=4)))
+        self.assertEqual([], list(hash_aggregate([], operator.add)))
+
+    def test_hash_join(self):
+        left = [(random.randint(0, 300), i) for i in xrange(2000)]
+        right = [(random.randint(100, 400), -i) for i in xrange(500)]
+        for how in ('inner', 'left', 'right', 'outer'):
+            expected = sorted(merge_join(sorted(left), sorted(right), key=itemgetter(0), how=how))
+            for max_mem in (DEFAULT_MAX_MEM, 2000):
+                self.assertEqual(expected, sorted(hash_join(left, right, key=itemgetter(0),
+                                                            how=how, max_mem=max_mem, fanout=4)))
+        # one key too big to fit is still joined
+        self.assertEqual(100, len(list(hash_join([1] * 10, [1] * 10, max_mem=10))))
+        self.assertRaises(ValueError, list, hash_join(left, right, how='cross'))
+
 class IndexedTest(unittest.TestCase):
     def test_indexed(self):
         tf = tempfile.TemporaryFile()
@@ -126,6 +798,16 @@ class IndexedTest(unittest.TestCase):
         tf.seek(0)
         self.assertEqual(20, len(iter(IndexedKVReader(tf))), 'length does not match')
 
+    def test_write_sorted_kv(self):
+        shared = ['shared value'] # pickled once per pair, not memoized
+        pairs = sorted((random.random(), shared) for _ in xrange(20))
+        sio = StringIO()
+        write_sorted_kv(sio, pairs)
+        self.assertEqual(pairs, list(IndexedKVReader(StringIO(sio.getvalue()))))
+        sio = StringIO()
+        write_sorted_kv(sio, [])
+        self.assertEqual([], list(IndexedKVReader(StringIO(sio.getvalue()))))
+
 class extsortedTest(unittest.TestCase):
     def test_extsorted_small(self):
         data = list(random.random() for _ in xrange(10))
@@ -271,6 +953,42 @@ class TransactionTest(unittest.TestCase):
         writer.write('outoftransaction')
         self.assertEqual(sio.getvalue(), '78abcxyzoutoftransaction')
 
+    def test_transaction_writer_savepoints(self):
+        sio = StringIO()
+        writer = TransactionWriter(sio, spill_size=10)
+        with writer:
+            writer.write('abc')
+            sp1 = writer.savepoint()
+            writer.write('def')
+            sp2 = writer.savepoint()
+            writer.write('ghi')
+            writer.rollback(sp2)
+            self.assertEqual(writer.mem_use(), 6)
+            writer.write('jkl')
+            writer.rollback(sp1)
+            self.assertRaises(ValueError, writer.rollback, sp2) # discarded by rollback to sp1
+            writer.write('mno')
+            writer.rollback(sp1) # still valid
+            writer.write('pqr')
+            writer.release(sp1)
+            self.assertRaises(ValueError, writer.rollback, sp1)
+            writer.commit()
+            self.assertEqual(sio.getvalue(), 'abcpqr')
+            writer.write('stu')
+            writer.rollback()
+            self.assertEqual(writer.mem_use(), 0)
+
+        # large transactions spill to disk
+        data = [random_string(100) for _ in xrange(100)]
+        with writer:
+            sp = writer.savepoint()
+            [writer.write(d) for d in data]
+            writer.rollback(sp)
+            [writer.write(d) for d in data]
+            self.assertEqual(writer.mem_use(), 100 * 100)
+            writer.commit()
+        self.assertEqual(sio.getvalue(), 'abcpqr' + ''.join(data))
+
     def test_transaction_reader(self):
         sio = StringIO()
         sio.write('1234567890abcdefg')
@@ -349,6 +1067,41 @@ class TransactionTest(unittest.TestCase):
             reader.commit()
         self.assertEqual(reader.mem_use(), 8)
 
+    def test_transaction_reader_buffer(self):
+        sio = StringIO('abcdefghij')
+        reader = TransactionReader(sio)
+        with reader:
+            self.assertEqual(str(reader.peek(3)), 'abc')
+            b = bytearray(4)
+            self.assertEqual(reader.readinto(b), 4)
+            self.assertEqual(b, bytearray('abcd'))
+            self.assertEqual(str(reader.peek()), '')
+            reader.commit(1)
+        with reader:
+            self.assertEqual(str(reader.peek()), 'bcd')
+            self.assertEqual(reader.read(2), 'bc')
+            reader.commit()
+            self.assertEqual(reader.read(1), 'd')
+        b = bytearray(10)
+        with reader:
+            self.assertEqual(reader.readinto(b), 7)
+            self.assertEqual(reader.readinto(b), 0)
+        self.assertEqual(b[:7], bytearray('defghij'))
+
+        # many small commits over a large window
+        data = ''.join(random_string(100) for _ in xrange(2000))
+        reader = TransactionReader(StringIO(data))
+        read_data = []
+        while True:
+            with reader:
+                chunk = reader.read(500)
+                if not chunk:
+                    break
+                read_data.append(chunk[:7])
+                reader.commit(7)
+        self.assertEqual(''.join(read_data), data)
+        self.assertEqual(reader.mem_use(), 0)
+
 class RecordReaderTest(unittest.TestCase):
     def test_recordreader(self):
         stream = StringIO()
@@ -387,6 +1140,239 @@ class RecordReaderTest(unittest.TestCase):
             last_count = min(last_count, len(values))
         self.assertEqual(len(value_counts), 4)
 
+    def test_scanner(self):
+        stream = StringIO()
+        write_data = [random_string(random.randint(1, 300), punctuation=True) for _ in xrange(50)]
+        write_data.append('###S##S#')
+        write_data.append(cPickle.dumps(2**40))
+        for i in write_data:
+            with RecordWriter(stream) as r:
+                r.write(i)
+        data = stream.getvalue()
+
+        # fed in blocks of all sizes, including ones that split sentinels
+        for block_size in (1, 2, 3, 7, 64, len(data)):
+            scanner = RecordScanner()
+            read_data = []
+            for i in xrange(0, len(data), block_size):
+                scanner.feed(data[i:i+block_size])
+                read_data.extend(record for _, record in scanner.scan())
+            read_data.extend(record for _, record in scanner.scan(final=True))
+            self.assertEqual(write_data, read_data)
+
+        # in place
+        for buf in (data, bytearray(data)):
+            records = list(RecordScanner(buf).scan(final=True))
+            self.assertEqual(write_data, [record for _, record in records])
+            self.assertEqual(records[0][0], 0)
+            self.assertTrue(all(data.startswith(SENTINEL, offset) for offset, _ in records))
+
+        tf = tempfile.TemporaryFile()
+        tf.write(data)
+        tf.seek(0)
+        self.assertEqual(write_data, list(MappedRecordReader(tf)))
+        tf.seek(1)
+        self.assertEqual(write_data[1:], list(MappedRecordReader(tf)))
+        tf.seek(0, os.SEEK_END)
+        self.assertEqual([], list(MappedRecordReader(tf)))
+
+    def test_range_reader(self):
+        tf = tempfile.NamedTemporaryFile()
+        write_data = [random_string(random.randint(1, 100), punctuation=True) for _ in xrange(200)]
+        write_data.append('#S' + cPickle.dumps(5) + 'nested')
+        framed = StringIO()
+        with RecordWriter(framed, version=2) as r:
+            r.write('inner-record')
+        write_data.insert(100, 'outer' + framed.getvalue() + 'outer') # escaped by version 1
+        for i in write_data:
+            with RecordWriter(tf) as r:
+                r.write(i)
+        tf.flush()
+        size = tf.tell()
+
+        # any split reads every record exactly once
+        for count in (1, 2, 4, 7, 50, size + 3):
+            ranges = split_ranges(size, count)
+            self.assertEqual(len(ranges), count)
+            read_data = []
+            for start, end in ranges:
+                read_data.extend(RangeRecordReader(tf, start, end))
+            self.assertEqual(write_data, read_data)
+
+        self.assertEqual(write_data, list(ParallelRecordReader(tf.name, processes=3, ranges=17)))
+        unordered = list(ParallelRecordReader(tf.name, processes=3, ordered=False))
+        self.assertEqual(sorted(write_data), sorted(unordered))
+        small = ParallelRecordReader(tf.name, processes=2, range_size=500, max_inflight=2)
+        self.assertEqual(write_data, list(small))
+
+        # a range reader that dies (e.g. out of memory) raises rather than hangs
+        read_range = vtil.records._read_range
+        vtil.records._read_range = _dying_range
+        try:
+            self.assertRaises(RuntimeError, list, ParallelRecordReader(tf.name, processes=2))
+        finally:
+            vtil.records._read_range = read_range
+
+    def test_scanner_large_record(self):
+        # fed in blocks much smaller than the record, which is not copied again for every block
+        stream = StringIO()
+        big = os.urandom(4 * 2**20)
+        with RecordWriter(stream, version=2) as r:
+            r.write(big)
+        with RecordWriter(stream, version=2) as r:
+            r.write('abc')
+        data = stream.getvalue()
+        scanner = RecordScanner()
+        read_data = []
+        wanted = []
+        for i in xrange(0, len(data), 4096):
+            scanner.feed(data[i:i+4096])
+            read_data.extend(record for _, record in scanner.scan())
+            wanted.append(scanner.wanted())
+        self.assertTrue(len(big) - 4096 < wanted[0] < len(big))
+        self.assertEqual(wanted[1:4], [wanted[0] - 4096, wanted[0] - 8192, wanted[0] - 12288])
+        read_data.extend(record for _, record in scanner.scan(final=True))
+        self.assertEqual(read_data, [big, 'abc'])
+
+    def test_version2(self):
+        stream = StringIO()
+        write_data = [random_string(random.randint(1, 100), punctuation=True) for _ in xrange(50)]
+        write_data.extend(['#S\x02' * 5, 'abc#', '##S\x80', '#S'])
+        for i, data in enumerate(write_data):
+            with RecordWriter(stream, version=1 + i % 2) as r:
+                r.write(data[:3])
+                r.write(data[3:])
+        data = stream.getvalue()
+        stream.seek(0)
+        self.assertEqual(write_data, list(RecordReader(stream)))
+        for block_size in (1, 5, 64):
+            scanner = RecordScanner()
+            read_data = []
+            for i in xrange(0, len(data), block_size):
+                scanner.feed(data[i:i+block_size])
+                read_data.extend(record for _, record in scanner.scan())
+            self.assertEqual(write_data, read_data)
+        self.assertRaises(ValueError, RecordWriter(stream, version=3).__enter__)
+
+        # resync after corruption
+        corrupt = bytearray(data)
+        offsets = [offset for offset, _ in RecordScanner(data).scan(final=True)]
+        for offset in offsets[10:40:3]:
+            corrupt[offset + 5] ^= 0xff
+        read_data = [record for _, record in RecordScanner(corrupt, tolerate_subsequent_error=True).scan(final=True)]
+        self.assertEqual(len(read_data), len(write_data) - 10)
+        self.assertTrue(set(read_data) <= set(write_data))
+
+        # zero-copy
+        tf = tempfile.NamedTemporaryFile()
+        for i in write_data:
+            with RecordWriter(tf, version=2) as r:
+                r.write(i)
+        tf.flush()
+        tf.seek(0)
+        read_data = list(MappedRecordReader(tf, copy=False))
+        self.assertTrue(all(isinstance(record, buffer) for record in read_data))
+        self.assertEqual(write_data, [str(record) for record in read_data])
+        self.assertEqual(write_data, list(ParallelRecordReader(tf.name, processes=2, ranges=9)))
+
+        # a range starting at a record that follows data ending in '#'
+        sio = StringIO()
+        with RecordWriter(sio, version=2) as r:
+            r.write('abc#')
+        boundary = sio.tell()
+        with RecordWriter(sio) as r:
+            r.write('def')
+        self.assertEqual(list(RangeRecordReader(sio, 0, boundary)), ['abc#'])
+        self.assertEqual(list(RangeRecordReader(sio, boundary)), ['def'])
+
+    def test_block_writer(self):
+        tf = tempfile.NamedTemporaryFile()
+        write_data = [random_string(random.randint(1, 100), punctuation=True) for _ in xrange(500)]
+        with RecordWriter(tf) as r:
+            r.write('first')
+        with RecordBlockWriter(tf, block_size=1000) as writer:
+            for data in write_data:
+                writer.write(data)
+        with RecordWriter(tf, version=2) as r:
+            r.write('last')
+        tf.flush()
+        size = tf.tell()
+        tf.seek(0)
+        write_data = ['first'] + write_data + ['last']
+        self.assertEqual(write_data, list(RecordReader(tf)))
+        tf.seek(0)
+        self.assertEqual(write_data, [str(r) for r in MappedRecordReader(tf, copy=False)])
+        for count in (3, 40):
+            read_data = []
+            for start, end in split_ranges(size, count):
+                read_data.extend(RangeRecordReader(tf, start, end))
+            self.assertEqual(write_data, read_data)
+
+        # blocks are compressed, and dropped whole when corrupt
+        tf.seek(0)
+        data = tf.read()
+        self.assertTrue(len(data) < sum(len(d) for d in write_data))
+        offsets = sorted(set(offset for offset, _ in RecordScanner(data).scan(final=True)))
+        self.assertTrue(len(offsets) > 10)
+        corrupt = bytearray(data)
+        corrupt[offsets[3] + 30] ^= 0xff
+        read_data = [record for _, record in RecordScanner(corrupt, tolerate_subsequent_error=True).scan(final=True)]
+        self.assertTrue(len(write_data) - 30 < len(read_data) < len(write_data))
+
+        # flush on time
+        sio = StringIO()
+        with RecordBlockWriter(sio, flush_interval=0) as writer:
+            writer.write('abc')
+            writer.write('def')
+        self.assertEqual(len(list(RecordScanner(sio.getvalue()).scan(final=True))), 2)
+        self.assertEqual(sio.getvalue().count(SENTINEL), 2)
+
+        # a quiet stream is flushed by polling maybe_flush()
+        sio = StringIO()
+        writer = RecordBlockWriter(sio, flush_interval=0.05)
+        self.assertFalse(writer.maybe_flush())
+        writer.write('abc')
+        time.sleep(0.1)
+        self.assertEqual(sio.getvalue(), '')
+        self.assertTrue(writer.maybe_flush())
+        self.assertFalse(writer.maybe_flush())
+        self.assertEqual([r for _, r in RecordScanner(sio.getvalue()).scan(final=True)], ['abc'])
+        self.assertFalse(RecordBlockWriter(sio).maybe_flush())
+
+    def test_index(self):
+        stream = StringIO()
+        index_file = StringIO()
+        write_data = [random_string(random.randint(1, 50), punctuation=True) for _ in xrange(100)]
+        for data in write_data[:30]:
+            with RecordWriter(stream, version=random.choice((1, 2)), index=index_file) as r:
+                r.write(data)
+        stream.write('garbage')
+        with RecordBlockWriter(stream, block_size=200, index=index_file) as writer:
+            for data in write_data[30:]:
+                writer.write(data)
+
+        index_file.seek(0)
+        index = RecordIndex(index_file)
+        self.assertEqual(len(index), len(write_data))
+        self.assertEqual(write_data, list(IndexedRecordReader(stream, index)))
+        self.assertEqual(write_data[42:57], list(IndexedRecordReader(stream, index, 42, 57)))
+        self.assertEqual(write_data[-1:], list(IndexedRecordReader(stream, index, len(index) - 1)))
+        self.assertRaises(IndexError, index.__getitem__, len(index))
+        ranges = index.split(3)
+        self.assertEqual(write_data, [record for start, stop in ranges
+                                      for record in IndexedRecordReader(stream, index, start, stop)])
+
+        # rebuilt index matches
+        rebuilt = StringIO()
+        stream.seek(0)
+        self.assertEqual(build_index(stream, rebuilt), len(write_data))
+        self.assertEqual(rebuilt.getvalue(), index_file.getvalue())
+
+        # stale index
+        stream.seek(0)
+        stream.write('x')
+        self.assertRaises(RecordReadError, list, IndexedRecordReader(stream, index))
+
     def test_pseudo_record(self):
         sio = StringIO()
         pre_data = [1,1,2,3,5]
@@ -429,3 +1415,102 @@ class RecordReaderTest(unittest.TestCase):
         self.check_partial_read(RecordReader(sio), 1)
         sio.seek(0)
         self.assertEqual(len(list(RecordReader(sio, tolerate_subsequent_error=True))), 2)
+
+class DiskBufferedTest(unittest.TestCase):
+    def test_output(self):
+        results = []
+        with DiskBufferedOutput(lambda f: results.append(f.read())) as out:
+            out.write('abc123')
+            out.write('xyz')
+        self.assertEqual(results, ['abc123xyz'])
+
+    def test_multipart_output(self):
+        parts = dict()
+        def part_func(part_number, part_file):
+            parts[part_number] = part_file.read()
+            return part_number * 10
+        results = []
+        with DiskBufferedOutput(results.append, part_func=part_func, part_size=4) as out:
+            out.write('abc')
+            out.write('123xyz7')
+            self.assertEqual(out.tell(), 10)
+            out.write('89')
+        self.assertEqual(results, [[0, 10, 20]])
+        self.assertEqual([parts[i] for i in xrange(3)], ['abc1', '23xy', 'z789'])
+
+        # parts that fail are raised on close
+        def bad_part_func(part_number, part_file):
+            raise IOError('upload failed')
+        out = DiskBufferedOutput(results.append, part_func=bad_part_func, part_size=4)
+        out.write('abc123')
+        self.assertRaises(IOError, out.close)
+
+    def test_multipart_output_bounded(self):
+        # write() waits for parts to be handed off rather than piling them up on disk
+        release = threading.Event()
+        def part_func(part_number, part_file):
+            release.wait()
+            return part_number
+        results = []
+        out = DiskBufferedOutput(results.append, part_func=part_func, part_size=1, threads=2)
+        writer = threading.Thread(target=out.write, args=('x' * 20,))
+        writer.start()
+        try:
+            time.sleep(0.2)
+            self.assertTrue(writer.is_alive())
+            self.assertEqual(out.tell(), 4) # 2 parts running, 2 queued, and a fifth waiting
+        finally:
+            release.set()
+            writer.join()
+        out.close()
+        self.assertEqual(results, [range(20)])
+
+class _ReversingChannel(RecordChannel):
+    def handle_record(self, record):
+        self.push_record(record[::-1])
+
+class _ClientChannel(RecordChannel):
+    def __init__(self, address, records, map):
+        RecordChannel.__init__(self, map=map, version=2)
+        self.expected = len(records)
+        self.received = []
+        self.done = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        for record in records:
+            self.push_record(record)
+
+    def handle_record(self, record):
+        self.received.append(record)
+        if len(self.received) == self.expected:
+            self.done = True
+            self.close()
+
+class AsyncRecordsTest(unittest.TestCase):
+    def test_loopback(self):
+        socket_map = dict()
+        server = RecordServer(('127.0.0.1', 0), _ReversingChannel, map=socket_map)
+        address = server.socket.getsockname()
+        sent = [[random_string(random.randint(1, 2000), punctuation=True) for _ in xrange(50)]
+                for _ in xrange(20)]
+        clients = [_ClientChannel(address, records, socket_map) for records in sent]
+        deadline = time.time() + 10
+        while not all(c.done for c in clients) and time.time() < deadline:
+            asyncore.loop(timeout=0.1, use_poll=True, map=socket_map, count=1)
+        server.close()
+        asyncore.close_all(map=socket_map)
+        for client, records in zip(clients, sent):
+            self.assertEqual(client.received, [record[::-1] for record in records])
+
+    def test_large_record(self):
+        socket_map = dict()
+        server = RecordServer(('127.0.0.1', 0), _ReversingChannel, map=socket_map)
+        address = server.socket.getsockname()
+        sent = [os.urandom(8 * 2**20), 'abc']
+        client = _ClientChannel(address, sent, socket_map)
+        deadline = time.time() + 20
+        while not client.done and time.time() < deadline:
+            asyncore.loop(timeout=0.1, use_poll=True, map=socket_map, count=1)
+        server.close()
+        asyncore.close_all(map=socket_map)
+        self.assertEqual(client.received, [record[::-1] for record in sent])
@@ -1,43 +1,347 @@
+import math
+
+from vtil.partition import stable_hash
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # update_many() falls back to pure Python
+
+class _Many(object):
+    ' Message to an accumulator generator: accumulate all of these values '
+    __slots__ = ('values',)
+    def __init__(self, values):
+        self.values = values
+
+class _Merge(object):
+    ' Message to an accumulator generator: fold in the state of another accumulator '
+    __slots__ = ('state',)
+    def __init__(self, state):
+        self.state = state
+
+class _STATETYPE(object): pass
+_STATE = _STATETYPE() # message to an accumulator generator: yield your state
+
 def make_accumulator(gen_type):
+    '''
+    Wraps a generator that is sent values and yields the accumulated result.
+    Besides plain values, the generator must handle three messages: _Many
+    (accumulate many values), _Merge (fold in another accumulator's state) and
+    _STATE (yield a picklable state, without changing the result).
+
+    Arguments to the wrapper are passed to the generator.
+    '''
     class wrapper(object):
-        def __init__(self):
-            self._a = gen_type()
+        def __init__(self, *args, **kwargs):
+            self._a = gen_type(*args, **kwargs)
             self._last = self._a.next()
-        
+
         def __call__(self, val=None):
             self._last = self._a.send(val)
             return self._last
-        
+
+        def update_many(self, values):
+            ' Accumulates all of *values* at once (NumPy arrays without a Python loop) '
+            self._last = self._a.send(_Many(values))
+            return self._last
+
+        def state(self):
+            ' Returns a picklable state that another accumulator of this type can merge() '
+            return self._a.send(_STATE)
+
+        def merge(self, other):
+            '''
+            Folds in the values accumulated by *other*, an accumulator of the
+            same type or its state(), e.g. from another thread or process.
+            '''
+            if isinstance(other, wrapper):
+                other = other.state()
+            self._last = self._a.send(_Merge(other))
+            return self._last
+
         def __str__(self):
             return str(self._last)
-        
+
         @property
         def value(self):
             return self._last
 
     return wrapper
 
+def _sum_count(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.sum().item(), values.size
+    if not hasattr(values, '__len__'):
+        values = list(values)
+    return sum(values), len(values)
+
 @make_accumulator
 def Averager():
-    value = 0.0
+    total = 0.0
     count = 0
+    out = None
     while True:
-        try: value += yield value/count
-        except ZeroDivisionError: value += yield None
-        count += 1
+        msg = yield out
+        if msg is _STATE:
+            out = (total, count)
+            continue
+        if isinstance(msg, _Many):
+            s, n = _sum_count(msg.values)
+        elif isinstance(msg, _Merge):
+            s, n = msg.state
+        else:
+            s, n = msg, 1
+        total += s
+        count += n
+        out = total/count if count else None
 
 @make_accumulator
 def Summer():
     value = 0
     while True:
-        value += yield value
+        msg = yield value
+        if msg is _STATE:
+            continue # the state is the sum
+        if isinstance(msg, _Many):
+            value += _sum_count(msg.values)[0]
+        elif isinstance(msg, _Merge):
+            value += msg.state
+        else:
+            value += msg
 
 @make_accumulator
 def Counter():
     count = 0
     while True:
-        yield count
+        msg = yield count
+        if msg is _STATE:
+            continue # the state is the count
+        if isinstance(msg, _Many):
+            values = msg.values
+            count += len(values) if hasattr(values, '__len__') else sum(1 for _ in values)
+        elif isinstance(msg, _Merge):
+            count += msg.state
+        else:
+            count += 1
+
+def _moments(values):
+    ' Returns (count, mean, sum of squared differences from the mean) of *values* '
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if not values.size:
+            return 0, 0.0, 0.0
+        mean = values.mean().item()
+        return values.size, mean, ((values - mean) ** 2).sum().item()
+    count, mean, m2 = 0, 0.0, 0.0
+    for x in values:
         count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += delta * (x - mean)
+    return count, mean, m2
+
+def _combine_moments(a, b):
+    ' Chan et al.\'s parallel combination of two (count, mean, m2) triples '
+    na, mean_a, m2_a = a
+    nb, mean_b, m2_b = b
+    n = na + nb
+    if not n:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    return n, mean_a + delta * nb / n, m2_a + m2_b + delta * delta * na * nb / n
+
+@make_accumulator
+def Variance():
+    ' Population variance by Welford\'s method (None until a value is seen) '
+    moments = (0, 0.0, 0.0)
+    out = None
+    while True:
+        msg = yield out
+        if msg is _STATE:
+            out = moments
+            continue
+        if isinstance(msg, _Many):
+            moments = _combine_moments(moments, _moments(msg.values))
+        elif isinstance(msg, _Merge):
+            moments = _combine_moments(moments, msg.state)
+        else:
+            moments = _combine_moments(moments, (1, float(msg), 0.0))
+        n, _, m2 = moments
+        out = m2 / n if n else None
+
+@make_accumulator
+def MinMax():
+    ' Yields (minimum, maximum) of the values seen, (None, None) until there are any '
+    low = high = None
+    while True:
+        msg = yield low, high
+        if msg is _STATE:
+            continue # the state is the result
+        if isinstance(msg, _Many):
+            values = msg.values
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                values = [values.min().item(), values.max().item()] if values.size else []
+            else:
+                values = list(values)
+        elif isinstance(msg, _Merge):
+            values = [v for v in msg.state if v is not None]
+        else:
+            values = [msg]
+        if values:
+            values.extend(v for v in (low, high) if v is not None)
+            low, high = min(values), max(values)
+
+class Quantiles(object):
+    '''
+    A DDSketch-style quantile sketch: values are counted in logarithmically
+    sized bins so that quantile() is within *relative_accuracy* of the true
+    value (for the rank it returns), in memory that grows with the log of the
+    range of values rather than their number. Past *max_bins* bins per sign,
+    the bins nearest zero are collapsed, losing accuracy there first.
+    '''
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.count = 0
+        self.zeros = 0
+        self.positive = {}
+        self.negative = {}
+
+    def add(self, value, count=1):
+        if value > 0:
+            self._add(self.positive, value, count)
+        elif value < 0:
+            self._add(self.negative, -value, count)
+        else:
+            self.zeros += count
+        self.count += count
+
+    def _add(self, bins, value, count):
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        bins[index] = bins.get(index, 0) + count
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def _collapse(self, bins):
+        indices = sorted(bins)
+        excess = len(bins) - self.max_bins
+        target = indices[excess]
+        for index in indices[:excess]:
+            bins[target] += bins.pop(index)
+
+    def state(self):
+        return self.gamma, self.zeros, dict(self.positive), dict(self.negative)
+
+    def merge(self, state):
+        gamma, zeros, positive, negative = state
+        if abs(gamma - self.gamma) > 1e-12:
+            raise ValueError("Cannot merge quantile sketches with different accuracies")
+        for bins, other in ((self.positive, positive), (self.negative, negative)):
+            for index, count in other.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zeros += zeros
+        self.count += zeros + sum(positive.itervalues()) + sum(negative.itervalues())
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        ' Returns an estimate of the *q* quantile (0 <= q <= 1), or None if empty '
+        if not self.count:
+            return None
+        if not 0 <= q <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+
+@make_accumulator
+def QuantileSketch(relative_accuracy=0.01, max_bins=2048):
+    ' Yields a Quantiles sketch of the values seen, e.g. acc.value.quantile(0.99) '
+    sketch = Quantiles(relative_accuracy, max_bins)
+    out = sketch
+    while True:
+        msg = yield out
+        out = sketch
+        if msg is _STATE:
+            out = sketch.state()
+            continue
+        if isinstance(msg, _Many):
+            add = sketch.add
+            for value in msg.values:
+                add(value)
+        elif isinstance(msg, _Merge):
+            sketch.merge(msg.state)
+        else:
+            sketch.add(msg)
+
+def _hll_alpha(m):
+    return {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+@make_accumulator
+def HyperLogLog(precision=12):
+    '''
+    Yields an estimate of the number of distinct values seen (strings or
+    numbers, hashed with partition.stable_hash), using 2**precision one-byte
+    registers for a standard error of about 1.04 / sqrt(2**precision).
+    '''
+    if not 4 <= precision <= 16:
+        raise ValueError("precision must be between 4 and 16")
+    m = 1 << precision
+    shift = 64 - precision
+    mask = (1 << shift) - 1
+    alpha_mm = _hll_alpha(m) * m * m
+    registers = bytearray(m)
+    total = float(m) # sum of 2**-register, kept up to date incrementally
+    zeros = m
+
+    def estimate():
+        e = alpha_mm / total
+        if e <= 2.5 * m and zeros:
+            return m * math.log(float(m) / zeros) # linear counting for small cardinalities
+        return e
+
+    def update(j, rank):
+        old = registers[j]
+        if rank > old:
+            registers[j] = rank
+            return 2.0 ** -rank - 2.0 ** -old, 1 if not old else 0
+        return 0.0, 0
+
+    out = 0
+    while True:
+        msg = yield out
+        if msg is _STATE:
+            out = str(registers)
+            continue
+        if isinstance(msg, _Merge):
+            if len(msg.state) != m:
+                raise ValueError("Cannot merge HyperLogLogs with different precisions")
+            updates = enumerate(bytearray(msg.state))
+        else:
+            values = msg.values if isinstance(msg, _Many) else [msg]
+            updates = ((h >> shift, shift - (h & mask).bit_length() + 1)
+                       for h in (stable_hash(v) for v in values))
+        for j, rank in updates:
+            delta, filled = update(j, rank)
+            total += delta
+            zeros -= filled
+        out = int(round(estimate()))
 
 if __name__ == '__main__':
     a = Averager()
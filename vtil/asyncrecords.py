@@ -0,0 +1,96 @@
+'''
+Record streams over sockets, driven by the asyncore event loop so that one
+thread can serve many connections.
+
+Usage:
+    class Echo(RecordChannel):
+        def handle_record(self, record):
+            self.push_record(record)
+
+    server = RecordServer(('localhost', 8000), Echo)
+    asyncore.loop(use_poll=True)
+
+Pass use_poll=True: asyncore's default select() loop fails once a descriptor
+number reaches FD_SETSIZE (usually 1024), i.e. with about a thousand
+connections open.
+'''
+
+import socket
+import asyncore
+import asynchat
+from cStringIO import StringIO
+
+from vtil.records import RecordScanner, RecordWriter, DEFAULT_VERSION
+
+class RecordChannel(asynchat.async_chat):
+    '''
+    A socket connection carrying records in both directions.
+
+    Incoming data is decoded with the same framing and corruption tolerance as
+    RecordReader, and handle_record() is called for each record as it arrives.
+    push_record() queues a record for sending. A RecordReadError raised while
+    decoding goes to handle_error(), which closes the channel by default.
+    '''
+    def __init__(self, sock=None, map=None, version=DEFAULT_VERSION,
+                 tolerate_pre_error=True, tolerate_subsequent_error=False):
+        asynchat.async_chat.__init__(self, sock, map)
+        self._version = version
+        self._scanner = RecordScanner(tolerate_pre_error=tolerate_pre_error,
+                                      tolerate_subsequent_error=tolerate_subsequent_error)
+
+    def push_record(self, data):
+        ' Queues *data* to be sent as one record '
+        buf = StringIO()
+        with RecordWriter(buf, version=self._version) as r:
+            r.write(data)
+        self.push(buf.getvalue())
+
+    def handle_record(self, record):
+        raise NotImplementedError("Must subclass RecordChannel and implement handle_record()")
+
+    def handle_end(self):
+        ' Called once the peer has closed the connection and all records are handled '
+        pass
+
+    def handle_read(self):
+        try:
+            data = self.recv(max(self.ac_in_buffer_size, self._scanner.wanted()))
+        except socket.error as e:
+            if e.args[0] in asynchat._BLOCKING_IO_ERRORS:
+                return
+            self.handle_error()
+            return
+        if data:
+            self._scanner.feed(data)
+            for _, record in self._scanner.scan():
+                self.handle_record(record)
+
+    def handle_close(self):
+        for _, record in self._scanner.scan(final=True):
+            self.handle_record(record)
+        self.close()
+        self.handle_end()
+
+    # records are framed by RecordScanner, not asynchat terminators
+    def collect_incoming_data(self, data):
+        raise NotImplementedError
+    def found_terminator(self):
+        raise NotImplementedError
+
+class RecordServer(asyncore.dispatcher):
+    ' Listens on *address*, and serves each connection with a *channel_class* '
+    def __init__(self, address, channel_class, map=None, backlog=128, **channel_args):
+        asyncore.dispatcher.__init__(self, map=map)
+        self._map = map
+        self._channel_class = channel_class
+        self._channel_args = channel_args
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(backlog)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, _ = pair
+            self._channel_class(sock, map=self._map, **self._channel_args)
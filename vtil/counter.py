@@ -1,8 +1,17 @@
+import sys
+import heapq
+import cPickle
+import tempfile
+import itertools
+from operator import itemgetter
+
+from vtil.sorting import extsorted, DEFAULT_MAX_MEM
+from vtil.pickle import PickleReader
+
 try:
     from collections import Counter # only in 2.7
 except ImportError:
     # imitate some basic functionality for <2.7
-    from operator import itemgetter
     from collections import defaultdict
     class Counter(defaultdict):
         def __init__(self, iterable):
@@ -14,3 +23,157 @@ except ImportError:
         def most_common(self):
             for k,v in sorted(self._dict.iteritems(), key=itemgetter(1), reverse=True):
                 yield k,v
+
+
+class TopKCounter(object):
+    '''
+    Counts the most frequent keys in fixed memory with the Space-Saving
+    algorithm: at most *k* keys are tracked, and a new key replaces the
+    least frequent one, inheriting its count as possible error.
+
+    Every key occurring more than N/k times (N being the total count) is
+    tracked, and a tracked key's count overestimates its true count by at most
+    its error, which is at most N/k. bounds(key) gives (lower, upper).
+    '''
+    def __init__(self, k, iterable=None):
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        self.k = k
+        self.total = 0
+        self._counts = {} # key -> [count, error]
+        self._heap = [] # (count when pushed, key): lower bounds, one per tracked key
+        if iterable is not None:
+            self.update(iterable)
+
+    def __len__(self): return len(self._counts)
+    def __contains__(self, key): return key in self._counts
+
+    def __getitem__(self, key):
+        ' The (over)estimated count of *key*, or 0 if it is not tracked '
+        entry = self._counts.get(key)
+        return entry[0] if entry is not None else 0
+
+    def bounds(self, key):
+        ' Returns (lower, upper) bounds on the true count of *key* '
+        entry = self._counts.get(key)
+        if entry is not None:
+            return entry[0] - entry[1], entry[0]
+        return 0, self._min_count()
+
+    def _min_count(self):
+        if len(self._counts) < self.k:
+            return 0
+        heap, counts = self._heap, self._counts
+        while True:
+            count, key = heap[0]
+            current = counts[key][0]
+            if current == count:
+                return count
+            heapq.heapreplace(heap, (current, key)) # stale: counts only grow
+
+    def add(self, key, count=1):
+        self.total += count
+        entry = self._counts.get(key)
+        if entry is not None:
+            entry[0] += count
+        elif len(self._counts) < self.k:
+            self._counts[key] = [count, 0]
+            heapq.heappush(self._heap, (count, key))
+        else:
+            smallest = self._min_count()
+            _, evicted = heapq.heappop(self._heap)
+            del self._counts[evicted]
+            self._counts[key] = [smallest + count, smallest]
+            heapq.heappush(self._heap, (smallest + count, key))
+
+    def update(self, iterable):
+        add = self.add
+        for key in iterable:
+            add(key)
+
+    def merge(self, other):
+        '''
+        Folds in the counts of another TopKCounter (e.g. from another worker).
+        Keys missing from one side are charged that side's minimum count as
+        possible error, so the bounds remain valid.
+        '''
+        mine, theirs = self._min_count(), other._min_count()
+        merged = {}
+        for key in set(self._counts) | set(other._counts):
+            count, error = self._counts.get(key, [mine, mine])
+            other_count, other_error = other._counts.get(key, [theirs, theirs])
+            merged[key] = [count + other_count, error + other_error]
+        keep = heapq.nlargest(self.k, merged.iteritems(), key=lambda item: item[1][0])
+        self._counts = dict(keep)
+        self._heap = [(entry[0], key) for key, entry in keep]
+        heapq.heapify(self._heap)
+        self.total += other.total
+
+    def most_common(self, n=None):
+        ' Yields (key, estimated count) for the *n* (default: all tracked) most frequent keys '
+        n = len(self._counts) if n is None else n
+        for key, entry in heapq.nlargest(n, self._counts.iteritems(), key=lambda item: item[1][0]):
+            yield key, entry[0]
+
+class SpillingCounter(object):
+    '''
+    Counts keys exactly in bounded memory. Once the counts held in memory use
+    more than *max_mem* bytes (estimated as for iterator.mem_chunks), they are
+    spilled to a temporary file, and spilled counts are merged by key through
+    extsorted() when read.
+
+    Keys must be sortable and picklable.
+    '''
+    def __init__(self, iterable=None, max_mem=DEFAULT_MAX_MEM):
+        self._max_mem = max_mem
+        self._counts = {}
+        self._mem = 0
+        self._spill = None
+        if iterable is not None:
+            self.update(iterable)
+
+    def add(self, key, count=1):
+        counts = self._counts
+        if key in counts:
+            counts[key] += count
+            return
+        counts[key] = count
+        self._mem += sys.getsizeof(key) + sys.getsizeof(count)
+        if self._mem > self._max_mem:
+            self._flush()
+
+    def update(self, iterable):
+        add = self.add
+        for key in iterable:
+            add(key)
+
+    def _flush(self):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        dump = cPickle.dump
+        for item in self._counts.iteritems():
+            dump(item, self._spill, cPickle.HIGHEST_PROTOCOL)
+        self._counts = {}
+        self._mem = 0
+
+    def iteritems(self):
+        ' Yields (key, count) for each key, in key order '
+        if self._spill is None:
+            items = iter(sorted(self._counts.iteritems()))
+        else:
+            self._spill.flush()
+            self._spill.seek(0)
+            spilled = PickleReader(self._spill)
+            items = extsorted(itertools.chain(spilled, self._counts.iteritems()),
+                              key=itemgetter(0), max_mem=self._max_mem)
+        for key, group in itertools.groupby(items, itemgetter(0)):
+            yield key, sum(count for _, count in group)
+
+    def most_common(self, n=None):
+        '''
+        Yields (key, count) for the *n* most common keys (all keys if n is
+        None), most common first, in memory bounded by *n* or by max_mem.
+        '''
+        if n is not None:
+            return iter(heapq.nlargest(n, self.iteritems(), key=itemgetter(1)))
+        return extsorted(self.iteritems(), key=itemgetter(1), reverse=True, max_mem=self._max_mem)
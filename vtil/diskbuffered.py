@@ -8,35 +8,104 @@ import tempfile
 import threading
 import os
 import socket
+import select
+import errno
+import time
+
+from functools import partial
+
+from vtil.threadpool import ThreadPool
+
+def _run_part(part_func, part):
+    part_number, part_file = part
+    try:
+        return part_number, part_func(part_number, part_file)
+    finally:
+        part_file.close()
 
 class DiskBufferedOutput(object):
     ''' Allows writing to a local disk file, then submits local file to a write
-    function for upload/archive/etc. on close. '''
+    function for upload/archive/etc. on close.
 
-    def __init__(self, writefunc):
+    If *part_func* is given, output is instead cut into parts of *part_size*
+    bytes. Each completed part is handed to part_func(part_number, file_obj)
+    on one of *threads* background threads while writing continues (part
+    numbers are zero-based). On close, only the tail is handed off, and once
+    all parts are done writefunc is called with the list of part_func return
+    values in part order (e.g. to complete a multipart upload). write() waits
+    while *threads* parts are already queued, so at most 2 * threads + 1 parts
+    are held on disk at a time. Only write() and tell() are available in this
+    mode. '''
+    default_part_size = 2**23 # 8 meg
+
+    def __init__(self, writefunc, part_func=None, part_size=default_part_size, threads=3):
         if not callable(writefunc):
             raise ValueError("writefunc must be a callable taking one argument")
         self._writefunc = writefunc
         self._file = tempfile.TemporaryFile()
-        
-        # forward
-        forwarded = ['read', 'readline', 'readlines', 'write', 'seek', 'tell']
-        for f in forwarded: setattr(self, f, getattr(self._file, f))
+        self._pool = None
+
+        if part_func is None:
+            # forward
+            forwarded = ['read', 'readline', 'readlines', 'write', 'seek', 'tell']
+            for f in forwarded: setattr(self, f, getattr(self._file, f))
+        else:
+            if not callable(part_func):
+                raise ValueError("part_func must be a callable taking two arguments")
+            if part_size <= 0:
+                raise ValueError("part_size must be positive")
+            self._part_size = part_size
+            self._part_count = 0
+            self._pool = ThreadPool(threads, partial(_run_part, part_func), max_queued=threads)
+            self._pool.start()
     
     def __enter__(self): return self
     def __exit__(self, ex, et, tb):
         self.close()
         return False
-    
-    def close(self):
+
+    def _push_part(self):
         self._file.flush()
         self._file.seek(0)
-        self._writefunc(self._file)
+        self._pool.push((self._part_count, self._file))
+        self._part_count += 1
+        self._file = tempfile.TemporaryFile()
+
+    def write(self, data):
+        ' Write to the current part, handing it off each time it fills up '
+        pos = 0
+        while pos < len(data):
+            space = self._part_size - self._file.tell()
+            self._file.write(data[pos:pos+space])
+            pos += space
+            if self._file.tell() >= self._part_size:
+                self._push_part()
+
+    def tell(self):
+        return self._part_count * self._part_size + self._file.tell()
+
+    def close(self):
+        if self._pool is None:
+            self._file.flush()
+            self._file.seek(0)
+            self._writefunc(self._file)
+            self._file.close()
+            return
+
+        if self._file.tell() or not self._part_count:
+            self._push_part() # tail
         self._file.close()
+        self._pool.join()
+        results = list(self._pool)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        self._writefunc([part_result for _, part_result in sorted(results)])
     
 class DiskBufferedInput(object):
     """ Reads file buffered to local disk """
     default_blocksize = 2**15 ## 1 meg
+    poll_interval = 0.1 # seconds to wait for a non-blocking source before checking for close()
 
     def __init__(self, fileobj, blocksize=default_blocksize, wait=False):
         self._buffer_lock = threading.RLock()
@@ -77,20 +146,29 @@ class DiskBufferedInput(object):
             raise ValueError("Cannot unread past beginning of buffer")
         self._buffer.seek(-count, os.SEEK_CUR)
 
+    def _wait_readable(self):
+        ' Waits (without holding the lock) for a non-blocking source to have data '
+        try:
+            select.select([self._fileobj], [], [], self.poll_interval)
+        except (TypeError, ValueError, select.error):
+            time.sleep(self.poll_interval) # no fileno()
+
     def _load(self):
         while not self._load_stop:
             with self._buffer_lock:
                 try:
                     data = self._fileobj.read(self._block_size)
                 except socket.error, (value, _):
-                    if value == 11:
-                        continue
-                    else:
+                    if value != errno.EAGAIN:
                         raise
-                written = self._append(data)
-                self._buffer_condition.notify()
-                if not written:
-                    break
+                    data = None
+                if data is not None:
+                    written = self._append(data)
+                    self._buffer_condition.notify()
+                    if not written:
+                        break
+                    continue
+            self._wait_readable()
             
     def read(self, n=-1):
         " Reads from local copy if possible, otherwise blocks until remote data arrives "
@@ -63,6 +63,35 @@ class IndexedKVWriter(object):
         self.file_obj.flush()
         #self.file_obj.close()
 
+def write_sorted_kv(file_obj, pairs):
+    '''
+    Writes (key, value) *pairs*, which must already be sorted by key, to
+    *file_obj* in the format of IndexedKVWriter. Unlike IndexedKVWriter, memory
+    use does not grow with the number of pairs: index entries and values are
+    spooled to temporary files, each pickled on its own so that no pickler
+    memo holds on to them.
+    '''
+    dump = cPickle.dump
+    protocol = cPickle.HIGHEST_PROTOCOL
+    index_file = tempfile.TemporaryFile()
+    value_file = tempfile.TemporaryFile()
+    try:
+        count = 0
+        for key, value in pairs:
+            dump((key, value_file.tell()), index_file, protocol)
+            dump(value, value_file, protocol)
+            count += 1
+        dump(count, file_obj, protocol) # number of elements
+        index_file.seek(0)
+        shutil.copyfileobj(index_file, file_obj) # index entries
+        dump(value_file.tell(), file_obj, protocol) # number of value bytes
+        value_file.seek(0)
+        shutil.copyfileobj(value_file, file_obj) # values
+        file_obj.flush()
+    finally:
+        index_file.close()
+        value_file.close()
+
 class IndexNotLoaded(Exception): pass
 class Empty(Exception): pass
 
@@ -80,7 +109,7 @@ class IndexedKVReader(object):
     def __exit__(self, et, ex, tb): return False
     
     def __iter__(self):
-        if not self._index:
+        if self._index is None: # empty indexes are already loaded
             self.read_index()
         return self
     
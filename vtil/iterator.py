@@ -1,7 +1,11 @@
 import itertools
 import threading
+import multiprocessing
+import multiprocessing.pool
 import Queue
 import sys
+import cPickle
+import collections
 
 from vtil import accum
 from vtil import exception
@@ -80,7 +84,10 @@ def mem_chunks(iterable, max_mem=None):
     if block:
         yield block
 
-class _STOPTYPE(object): pass
+class _STOPTYPE(object):
+    ' The type of _STOP, which unpickles as _STOP itself, so it can end streams between processes too '
+    def __reduce__(self):
+        return '_STOP'
 _STOP = _STOPTYPE()
 
 def _load_thread(iterable, q):
@@ -104,7 +111,109 @@ def _load_thread_mem(iterable, q, lock, not_empty, not_full, max_mem):
                     not_empty.notify()
                     not_full.wait()
 
-def threaded(iterable, max_count=None, max_mem=None):
+_POLL_INTERVAL = 0.1 # seconds between checks for a stop, or for dead worker processes
+
+class _Failure(object):
+    ' Carries an exception raised in the producer thread to the consumer '
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class _ByteBound(object):
+    '''
+    Limits the bytes in flight between threads. A batch larger than the whole
+    budget is still admitted once nothing else is in flight.
+    '''
+    def __init__(self, max_mem):
+        self._max_mem = max_mem
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size, stop):
+        with self._cond:
+            while self._used and self._used + size > self._max_mem:
+                if stop.is_set():
+                    return False
+                self._cond.wait(_POLL_INTERVAL)
+            self._used += size
+            return True
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify()
+
+def _put(q, item, stop):
+    ' Put *item* on *q*, giving up if *stop* is set while waiting for room '
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _batched(iterable, batch_size):
+    ' Yields lists of *batch_size* values, delivering any partial batch before an exception '
+    batch = []
+    append = batch.append
+    try:
+        for value in iterable:
+            append(value)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+                append = batch.append
+    except Exception:
+        if not batch:
+            raise
+        exc_type, exc_value, tb = sys.exc_info()
+        yield batch
+        raise exc_type, exc_value, tb
+    if batch:
+        yield batch
+
+def _load_thread_batched(iterable, q, batch_size, bound, stop):
+    sizeof = sys.getsizeof
+    try:
+        for batch in _batched(iterable, batch_size):
+            if stop.is_set():
+                return
+            size = 0
+            if bound is not None:
+                size = sum(sizeof(v) for v in batch)
+                if not bound.acquire(size, stop):
+                    return
+            if not _put(q, (batch, size), stop):
+                return
+    except Exception:
+        _put(q, (_Failure(sys.exc_info()), 0), stop)
+    else:
+        _put(q, (_STOP, 0), stop)
+
+def _threaded_batched(iterable, max_count, max_mem, batch_size):
+    q = Queue.Queue(maxsize=max_count or 0)
+    bound = _ByteBound(max_mem) if max_mem is not None else None
+    stop = threading.Event()
+    thread = threading.Thread(target=_load_thread_batched,
+                              args=(iterable, q, batch_size, bound, stop))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch, size = q.get()
+            if batch is _STOP:
+                break
+            if isinstance(batch, _Failure):
+                exc_type, exc_value, tb = batch.exc_info
+                raise exc_type, exc_value, tb
+            if bound is not None:
+                bound.release(size)
+            for val in batch:
+                yield val
+    finally:
+        stop.set()
+
+def threaded(iterable, max_count=None, max_mem=None, batch_size=None):
     '''
     Loads values from *iterable* in a background thread and yields them.
 
@@ -116,9 +225,19 @@ def threaded(iterable, max_count=None, max_mem=None):
     This is useful for wrapping iterators that perform IO. Though the benefit is
     small since it introduces pickling overhead (in the queue communication between
     threads). So the IO being wrapped should be very slow (e.g. network, not disk).
-    
-    TODO: Tests
+
+    If *batch_size* is specified, values are handed between threads in lists of
+    up to that many, which keeps locking overhead low for small values. In this
+    mode *max_count* limits the number of batches in flight and *max_mem* the
+    total size of the values in flight, an exception raised by *iterable* is
+    re-raised in the consumer, and the background thread stops when the
+    consumer closes the generator.
     '''
+    if batch_size is not None:
+        return _threaded_batched(iterable, max_count, max_mem, batch_size)
+    return _threaded(iterable, max_count, max_mem)
+
+def _threaded(iterable, max_count, max_mem):
     q = Queue.Queue(maxsize=max_count)
     if max_mem is None:
         target=_load_thread
@@ -147,6 +266,223 @@ def threaded(iterable, max_count=None, max_mem=None):
             raise StopIteration
         yield val
 
+def _picklable(exc, who):
+    ' Returns *exc*, or a RuntimeError describing it if it can\'t be pickled to another process '
+    try:
+        cPickle.dumps(exc, cPickle.HIGHEST_PROTOCOL)
+    except Exception: # a queue's feeder thread would drop it
+        return RuntimeError('%s raised %r' % (who, exc))
+    return exc
+
+def _exited(processes):
+    ' Returns one of *processes* that has exited, or None '
+    for process in processes:
+        if process.exitcode is not None:
+            return process
+    return None
+
+def _died(process):
+    return RuntimeError('worker process exited (exit code %s) without finishing' % process.exitcode)
+
+def _get_checked(q, processes):
+    '''
+    Gets an item from the multiprocessing queue *q*, raising RuntimeError if
+    one of *processes*, which fill it, exits with nothing left on *q*.
+    '''
+    while True:
+        try:
+            return q.get(timeout=_POLL_INTERVAL)
+        except Queue.Empty:
+            dead = _exited(processes)
+            if dead is not None:
+                break
+    try:
+        return q.get(timeout=_POLL_INTERVAL) # anything flushed just before it exited
+    except Queue.Empty:
+        raise _died(dead)
+
+def _put_checked(q, item, processes):
+    '''
+    Puts *item* on the multiprocessing queue *q*, raising RuntimeError if it is
+    full and all of *processes*, which drain it, have exited.
+    '''
+    while True:
+        try:
+            return q.put(item, timeout=_POLL_INTERVAL)
+        except Queue.Full:
+            if all(process.exitcode is not None for process in processes):
+                raise RuntimeError('every worker process has exited')
+
+class _SharedByteBound(_ByteBound):
+    ' A _ByteBound shared between processes '
+    def __init__(self, max_mem):
+        self._max_mem = max_mem
+        self._shared = multiprocessing.Value('l', 0, lock=False)
+        self._cond = multiprocessing.Condition()
+
+    def _get_used(self): return self._shared.value
+    def _set_used(self, value): self._shared.value = value
+    _used = property(_get_used, _set_used)
+
+def _load_process(func, args, kwargs, q, batch_size, bound, stop):
+    dumps = cPickle.dumps
+    try:
+        for batch in _batched(func(*args, **kwargs), batch_size):
+            data = dumps(batch, cPickle.HIGHEST_PROTOCOL)
+            if bound is not None and not bound.acquire(len(data), stop):
+                break
+            if not _put(q, data, stop):
+                break
+        else:
+            _put(q, _STOP, stop)
+    except Exception as e:
+        e = _picklable(e, 'producer')
+        _put(q, _Failure((type(e), e, None)), stop)
+    if stop.is_set():
+        q.cancel_join_thread() # consumer has gone, don't wait to flush
+
+def processed(func, args=(), kwargs=None, max_count=None, max_mem=None, batch_size=100):
+    '''
+    Runs func(*args, **kwargs) in a separate process and yields the values from
+    the iterable it returns.
+
+    Unlike threaded(), the producer runs on another core rather than sharing the
+    GIL, so this is useful for CPU-bound producers like parsers and decoders.
+    *func* and its arguments must be picklable on platforms without fork().
+
+    Values are pickled and shipped in batches of up to *batch_size*. If
+    *max_count* is specified, only that many batches will be loaded ahead of
+    the consumer. If *max_mem* is specified, only batches occupying less than
+    that many pickled bytes will be loaded ahead.
+
+    Exceptions raised by the producer are re-raised in the consumer (without
+    the remote traceback), and closing the generator stops the producer. If
+    the producer process dies without finishing (killed, out of memory or
+    os._exit()), the consumer raises RuntimeError rather than waiting forever.
+    '''
+    q = multiprocessing.Queue(maxsize=max_count or 0)
+    bound = _SharedByteBound(max_mem) if max_mem is not None else None
+    stop = multiprocessing.Event()
+    proc = multiprocessing.Process(target=_load_process,
+                                   args=(func, args, kwargs or {}, q, batch_size, bound, stop))
+    proc.daemon = True
+    proc.start()
+    loads = cPickle.loads
+    try:
+        while True:
+            data = _get_checked(q, [proc])
+            if data is _STOP:
+                break
+            if isinstance(data, _Failure):
+                exc_type, exc_value, tb = data.exc_info
+                raise exc_type, exc_value, tb
+            if bound is not None:
+                bound.release(len(data))
+            for val in loads(data):
+                yield val
+    finally:
+        stop.set()
+        proc.join(1)
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+def _map_chunk(func, chunk):
+    return [func(value) for value in chunk]
+
+def _map_chunk_caught(func, chunk):
+    ' apply_async() in 2.7 has no error callback, so exceptions travel as results '
+    try:
+        return True, _map_chunk(func, chunk)
+    except Exception as e:
+        return False, _picklable(e, getattr(func, '__name__', 'func'))
+
+def _check_workers(workers):
+    '''
+    Raises RuntimeError if one of *workers*, the original processes of a
+    multiprocessing.Pool, has exited. The pool replaces dead workers, but the
+    chunks they held never finish.
+    '''
+    dead = _exited(workers)
+    if dead is not None:
+        raise _died(dead)
+
+def _chunk_result(result, workers):
+    ' Waits for the AsyncResult of a _map_chunk_caught() call and returns its values '
+    if workers is not None:
+        while not result.ready():
+            _check_workers(workers)
+            result.wait(_POLL_INTERVAL)
+    ok, values = result.get()
+    if not ok:
+        raise values
+    return values
+
+def parallel_map(func, iterable, workers=None, chunksize=1, max_inflight=None,
+                 ordered=True, backend='thread'):
+    '''
+    Yields func(value) for each value in *iterable*, computed by a pool of
+    *workers* threads (backend='thread') or processes (backend='process').
+
+    Values are sent to workers in chunks of *chunksize*, and at most
+    *max_inflight* chunks (default: twice the number of workers) are pending
+    at a time, so *iterable* is consumed lazily and may be infinite.
+
+    If *ordered* is True, results are yielded in the order of *iterable*,
+    otherwise in the order chunks complete. An exception raised by *func* is
+    re-raised in the caller (as a RuntimeError describing it if it can't be
+    pickled). With the process backend, *func* must be picklable (i.e. defined
+    at module level), and a worker process that dies (killed, out of memory or
+    os._exit()) makes the caller raise RuntimeError rather than wait forever.
+    '''
+    if backend == 'thread':
+        pool = multiprocessing.pool.ThreadPool(workers)
+        processes = None
+    elif backend == 'process':
+        pool = multiprocessing.Pool(workers)
+        processes = list(pool._pool)
+    else:
+        raise ValueError('backend must be \'thread\' or \'process\'')
+    if max_inflight is None:
+        max_inflight = 2 * (workers or multiprocessing.cpu_count())
+    try:
+        if ordered:
+            pending = collections.deque()
+            for chunk in chunks(chunksize, iterable):
+                pending.append(pool.apply_async(_map_chunk_caught, (func, chunk)))
+                if len(pending) >= max_inflight:
+                    for result in _chunk_result(pending.popleft(), processes):
+                        yield result
+            while pending:
+                for result in _chunk_result(pending.popleft(), processes):
+                    yield result
+        else:
+            done = Queue.Queue()
+            pending = {}
+            def completed():
+                while True:
+                    try:
+                        n = done.get(timeout=_POLL_INTERVAL)
+                    except Queue.Empty:
+                        # a chunk whose results can't be pickled finishes without a callback
+                        n = next((n for n, result in pending.iteritems() if result.ready()), None)
+                        if n is None and processes is not None:
+                            _check_workers(processes)
+                    if n in pending:
+                        return _chunk_result(pending.pop(n), processes)
+            for n, chunk in enumerate(chunks(chunksize, iterable)):
+                pending[n] = pool.apply_async(_map_chunk_caught, (func, chunk),
+                                              callback=lambda _, n=n: done.put(n))
+                if len(pending) >= max_inflight:
+                    for result in completed():
+                        yield result
+            while pending:
+                for result in completed():
+                    yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
 if __name__ == '__main__':
     import random
     import time
@@ -0,0 +1,245 @@
+'''
+Joins and aggregations over data larger than memory.
+
+groupby_sorted() and merge_join() stream over sorted iterables (e.g. from
+extsorted() or an IndexedKVReader), in memory bounded by the largest group.
+hash_aggregate() and hash_join() need no sorting: they work in memory until a
+budget is exceeded, then partition the data into temporary files by hash and
+process each partition on its own (Grace hashing).
+
+Usage:
+    for profile, order in merge_join(profiles, orders, key=itemgetter(0), how='left'):
+        ...
+    for word, count in hash_aggregate(((w, 1) for w in words), operator.add):
+        ...
+'''
+
+import sys
+import cPickle
+import tempfile
+import operator
+import itertools
+
+from vtil.sorting import DEFAULT_MAX_MEM
+from vtil.pickle import PickleReader
+
+HOWS = ('inner', 'left', 'right', 'outer')
+
+class SpilledGroup(object):
+    '''
+    A group too large for memory, kept pickled in a temporary file. It can be
+    iterated many times, but not by two iterations at once.
+    '''
+    def __init__(self, items):
+        self._file = tempfile.TemporaryFile()
+        self._len = 0
+        self.extend(items)
+
+    def __len__(self): return self._len
+
+    def append(self, item):
+        self._file.seek(0, 2) # an iteration may have left the position anywhere
+        # not a Pickler: its memo would keep every item alive
+        cPickle.dump(item, self._file, cPickle.HIGHEST_PROTOCOL)
+        self._len += 1
+
+    def extend(self, items):
+        [self.append(item) for item in items]
+
+    def __iter__(self):
+        self._file.flush()
+        self._file.seek(0)
+        return PickleReader(self._file)
+
+def _identity(x): return x
+
+class _ENDTYPE(object): pass
+_END = _ENDTYPE()
+
+def _group(first, itr, key, k, max_mem):
+    ' Collects items with key *k* after *first*, returning (group, next item or _END) '
+    sizeof = sys.getsizeof
+    group = [first]
+    mem_use = sizeof(first)
+    for item in itr:
+        if key(item) != k:
+            return group, item
+        if mem_use is not None:
+            mem_use += sizeof(item)
+            if mem_use > max_mem:
+                group = SpilledGroup(group)
+                mem_use = None
+        group.append(item)
+    return group, _END
+
+def groupby_sorted(iterable, key=None, max_mem=DEFAULT_MAX_MEM):
+    '''
+    Like itertools.groupby(), yields (key, group) for each run of items with
+    equal keys, but each group is a sequence that can be iterated repeatedly
+    after the next group is read: a list, or a SpilledGroup once the group uses
+    more than *max_mem* bytes (estimated as for iterator.mem_chunks).
+
+    Raises ValueError if the keys of *iterable* are not in ascending order.
+    '''
+    key = key or _identity
+    itr = iter(iterable)
+    pending = next(itr, _END)
+    last = _END
+    while pending is not _END:
+        k = key(pending)
+        if last is not _END and k < last:
+            raise ValueError("groupby_sorted: input is not sorted (%r after %r)" % (k, last))
+        group, pending = _group(pending, itr, key, k, max_mem)
+        last = k
+        yield k, group
+
+def _sides(how):
+    if how not in HOWS:
+        raise ValueError("how must be one of %s" % ', '.join(HOWS))
+    return how in ('left', 'outer'), how in ('right', 'outer')
+
+def merge_join(left, right, key=None, how='inner', left_key=None, right_key=None,
+               max_mem=DEFAULT_MAX_MEM):
+    '''
+    Joins two iterables sorted by *key* (or by *left_key* and *right_key*
+    respectively), yielding (left_item, right_item) for every pair of items
+    with equal keys, in key order.
+
+    With how='left', 'right' or 'outer', items with no match on the other side
+    are also yielded, paired with None. Only one group of equal keys from each
+    side is held at a time, spilling to disk past *max_mem* bytes.
+    '''
+    keep_left, keep_right = _sides(how)
+    lgroups = groupby_sorted(left, left_key or key, max_mem)
+    rgroups = groupby_sorted(right, right_key or key, max_mem)
+    l = next(lgroups, None)
+    r = next(rgroups, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            if keep_left:
+                for item in l[1]:
+                    yield item, None
+            l = next(lgroups, None)
+        elif l is None or r[0] < l[0]:
+            if keep_right:
+                for item in r[1]:
+                    yield None, item
+            r = next(rgroups, None)
+        else:
+            rgroup = r[1]
+            for litem in l[1]:
+                for ritem in rgroup:
+                    yield litem, ritem
+            l = next(lgroups, None)
+            r = next(rgroups, None)
+
+DEFAULT_FANOUT = 16
+_MAX_DEPTH = 8 # past this, partitions are processed in memory whatever their size
+
+def _partition(items, key, depth, fanout):
+    ' Spills *items* into *fanout* temporary files by a hash of their key that differs per *depth* '
+    files = [tempfile.TemporaryFile() for _ in xrange(fanout)]
+    dump = cPickle.dump
+    for item in items:
+        dump(item, files[hash((depth, key(item))) % fanout], cPickle.HIGHEST_PROTOCOL)
+    for f in files:
+        f.flush()
+        f.seek(0)
+    return files
+
+def _partitions(files):
+    for f in files:
+        yield PickleReader(f)
+        f.close()
+
+def hash_aggregate(pairs, combine, max_mem=DEFAULT_MAX_MEM, fanout=DEFAULT_FANOUT, _depth=0):
+    '''
+    Yields (key, value) for each distinct key of the (key, value) *pairs*, with
+    the values of each key folded together by *combine*, an associative binary
+    function like operator.add, in no particular order.
+
+    When the table of keys uses more than *max_mem* bytes (estimated as for
+    iterator.mem_chunks), partial aggregates are spilled into *fanout*
+    partitions by key hash, and each partition is then aggregated on its own,
+    recursively if it is still too large.
+    '''
+    sizeof = sys.getsizeof
+    table = {}
+    mem_use = 0
+    spilled = None
+    itr = iter(pairs)
+    for key, value in itr:
+        if key in table:
+            table[key] = combine(table[key], value)
+            continue
+        table[key] = value
+        mem_use += sizeof(key) + sizeof(value)
+        if mem_use > max_mem and _depth < _MAX_DEPTH:
+            # spill the partial aggregates and the rest of the input
+            items = itertools.chain(table.iteritems(), itr)
+            spilled = _partition(items, operator.itemgetter(0), _depth, fanout)
+            break
+    if spilled is None:
+        for item in table.iteritems():
+            yield item
+        return
+    table = None
+    for partition in _partitions(spilled):
+        for item in hash_aggregate(partition, combine, max_mem, fanout, _depth + 1):
+            yield item
+
+def hash_join(left, right, key=None, how='inner', left_key=None, right_key=None,
+              max_mem=DEFAULT_MAX_MEM, fanout=DEFAULT_FANOUT, _depth=0):
+    '''
+    Joins two unsorted iterables on *key* (or *left_key* and *right_key*),
+    yielding (left_item, right_item) pairs as merge_join() does, in no
+    particular order.
+
+    The *right* side is built into a hash table and *left* streamed against
+    it, so *right* should be the smaller side. If the table grows past
+    *max_mem* bytes, both sides are partitioned into *fanout* temporary files
+    by key hash and each pair of partitions is joined on its own, recursively
+    if needed. A single key with more rows than fit in *max_mem* is eventually
+    joined in memory regardless.
+    '''
+    keep_left, keep_right = _sides(how)
+    lkey = left_key or key or _identity
+    rkey = right_key or key or _identity
+    sizeof = sys.getsizeof
+    table = {}
+    mem_use = 0
+    spilled = None
+    itr = iter(right)
+    for item in itr:
+        table.setdefault(rkey(item), []).append(item)
+        mem_use += sizeof(item)
+        if mem_use > max_mem and _depth < _MAX_DEPTH:
+            items = itertools.chain(itertools.chain.from_iterable(table.itervalues()), itr)
+            spilled = _partition(items, rkey, _depth, fanout)
+            break
+
+    if spilled is None:
+        matched = set()
+        for litem in left:
+            k = lkey(litem)
+            ritems = table.get(k)
+            if ritems:
+                if keep_right:
+                    matched.add(k)
+                for ritem in ritems:
+                    yield litem, ritem
+            elif keep_left:
+                yield litem, None
+        if keep_right:
+            for k, ritems in table.iteritems():
+                if k not in matched:
+                    for ritem in ritems:
+                        yield None, ritem
+        return
+
+    table = None
+    lspilled = _partition(left, lkey, _depth, fanout)
+    for lpart, rpart in itertools.izip(_partitions(lspilled), _partitions(spilled)):
+        for pair in hash_join(lpart, rpart, how=how, left_key=lkey, right_key=rkey,
+                              max_mem=max_mem, fanout=fanout, _depth=_depth + 1):
+            yield pair
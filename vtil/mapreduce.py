@@ -0,0 +1,203 @@
+'''
+A single-machine MapReduce: map -> partition -> sort -> reduce on a local
+process pool, spilling to disk under a memory budget.
+
+Usage:
+    def mapper(line):
+        for word in line.split():
+            yield word, 1
+
+    def reducer(word, counts):
+        yield word, sum(counts)
+
+    def combiner(word, counts):
+        yield sum(counts)
+
+    with MapReduce(mapper, reducer, combiner=combiner) as job:
+        job.run(open('input.txt'))
+        for word, count in job.results():
+            print word, count
+        print job.timings
+
+mapper, reducer and combiner must be picklable (defined at module level).
+'''
+
+import os
+import time
+import cPickle
+import heapq
+import shutil
+import tempfile
+import operator
+import itertools
+import multiprocessing
+
+from vtil.sorting import DEFAULT_MAX_MEM, make_wrap_funcs
+from vtil.records import RecordWriter, RecordReader
+from vtil.partition import StableHashPartitioner
+from vtil.shuffle import ShuffleWriter, read_bucket
+from vtil.iterator import chunks, parallel_map, _STOP, _picklable, _get_checked, _put_checked
+
+def _bucket_path(workdir, task, partition):
+    return os.path.join(workdir, 'map-%05d-part-%05d' % (task, partition))
+
+def _output_path(workdir, partition):
+    return os.path.join(workdir, 'out-%05d' % partition)
+
+def _map_task(task, splits, mapper, combiner, partitioner, max_mem, workdir):
+    ' Shuffles the map output of every split in *splits* into the bucket files of *task* '
+    start = time.time()
+    files = [open(_bucket_path(workdir, task, p), 'wb') for p in xrange(len(partitioner))]
+    try:
+        with ShuffleWriter(partitioner, files.__getitem__, max_mem=max_mem,
+                           sort=True, combiner=combiner) as writer:
+            for split in splits:
+                writer.write_pairs(itertools.chain.from_iterable(itertools.imap(mapper, split)))
+    finally:
+        [f.close() for f in files]
+    return sum(writer.counts), time.time() - start
+
+def _map_worker(task, inqueue, outqueue, args):
+    ' Runs map task *task* over the splits arriving on *inqueue*, then reports on *outqueue* '
+    try:
+        result = _map_task(task, iter(inqueue.get, _STOP), *args)
+    except Exception as e:
+        result = _picklable(e, 'map task %d' % task)
+    outqueue.put((task, result))
+
+def _reduce_task(args):
+    partition, map_tasks, reducer, workdir = args
+    start = time.time()
+    files = [open(_bucket_path(workdir, task, partition), 'rb') for task in xrange(map_tasks)]
+    count = 0
+    try:
+        wrap, unwrap = make_wrap_funcs(key=operator.itemgetter(0)) # don't compare values
+        merged = heapq.merge(*[itertools.imap(wrap, read_bucket(f)) for f in files])
+        pairs = itertools.imap(unwrap, merged) # each bucket is sorted, so this is too
+        with open(_output_path(workdir, partition), 'wb') as out:
+            dumps = cPickle.dumps
+            for key, group in itertools.groupby(pairs, operator.itemgetter(0)):
+                for result in reducer(key, itertools.imap(operator.itemgetter(1), group)):
+                    with RecordWriter(out, version=2) as r:
+                        r.write(dumps(result, cPickle.HIGHEST_PROTOCOL))
+                    count += 1
+    finally:
+        [f.close() for f in files]
+    for task in xrange(map_tasks):
+        os.remove(_bucket_path(workdir, task, partition))
+    return count, time.time() - start
+
+class MapReduce(object):
+    '''
+    Runs *mapper* over the input and *reducer* over the grouped map output.
+
+    mapper(value) yields (key, value) pairs for each input value, and
+    reducer(key, values) is called once per distinct key, in key order within
+    each partition, and yields results. An optional combiner(key, values)
+    pre-reduces map output as for ShuffleWriter.
+
+    Keys are split into *partitions* by *partitioner* (by default a
+    StableHashPartitioner, so keys partition the same way in every process),
+    and each map task uses up to *max_mem* for buffering before spilling sorted
+    runs to *workdir* (a temporary directory by default, removed by close()).
+
+    There is one map task per process (*processes*, one per CPU by default),
+    each taking splits of the input as it becomes free, so each reduce task
+    reads one bucket file per process however large the input is.
+    '''
+    def __init__(self, mapper, reducer, partitions=4, combiner=None, partitioner=None,
+                 processes=None, max_mem=DEFAULT_MAX_MEM, workdir=None):
+        self._mapper = mapper
+        self._reducer = reducer
+        self._combiner = combiner
+        self._partitioner = partitioner or StableHashPartitioner(partitions)
+        self._processes = processes
+        self._max_mem = max_mem
+        self._own_workdir = workdir is None
+        self._workdir = tempfile.mkdtemp(prefix='vtil-mapreduce-') if workdir is None else workdir
+        self.outputs = []
+        self.timings = {}
+        self.counters = {}
+
+    def __enter__(self): return self
+    def __exit__(self, et, ev, tb):
+        self.close()
+        return False
+
+    def _map(self, inputs, split_size):
+        ' Runs the map tasks, returning the number of splits and each task\'s (count, seconds) '
+        tasks = self._processes or multiprocessing.cpu_count()
+        inqueue = multiprocessing.Queue(maxsize=2 * tasks) # only a few splits in flight
+        outqueue = multiprocessing.Queue()
+        args = (self._mapper, self._combiner, self._partitioner, self._max_mem, self._workdir)
+        procs = [multiprocessing.Process(target=_map_worker, args=(task, inqueue, outqueue, args))
+                 for task in xrange(tasks)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        results = {}
+        try:
+            splits = 0
+            try:
+                for split in chunks(split_size, inputs):
+                    if not outqueue.empty():
+                        break # only a failed task reports before its _STOP
+                    _put_checked(inqueue, split, procs)
+                    splits += 1
+                else:
+                    [_put_checked(inqueue, _STOP, procs) for _ in procs]
+            except RuntimeError:
+                pass # every map task has exited, find out why below
+            while len(results) < tasks:
+                unfinished = [proc for task, proc in enumerate(procs) if task not in results]
+                task, result = _get_checked(outqueue, unfinished)
+                if isinstance(result, Exception):
+                    raise result
+                results[task] = result
+        finally:
+            for proc in procs:
+                if len(results) < tasks:
+                    proc.terminate()
+                proc.join()
+        return splits, [results[task] for task in xrange(tasks)]
+
+    def run(self, inputs, split_size=1024):
+        '''
+        Runs the job over the values of *inputs*, which are sent to map tasks in
+        splits of *split_size*. Returns the output files, one per partition in
+        partition order, and fills in the job's timings (seconds per stage and
+        per task) and counters.
+        '''
+        start = time.time()
+        splits, map_results = self._map(inputs, split_size)
+        map_done = time.time()
+
+        reduce_args = [(partition, len(map_results), self._reducer, self._workdir)
+                       for partition in xrange(len(self._partitioner))]
+        reduce_results = list(parallel_map(_reduce_task, reduce_args, workers=self._processes,
+                                           backend='process'))
+        reduce_done = time.time()
+
+        self.outputs = [_output_path(self._workdir, partition)
+                        for partition in xrange(len(self._partitioner))]
+        self.timings = dict(map=map_done - start,
+                            reduce=reduce_done - map_done,
+                            total=reduce_done - start,
+                            map_tasks=[t for _, t in map_results],
+                            reduce_tasks=[t for _, t in reduce_results])
+        self.counters = dict(map_tasks=len(map_results),
+                             map_splits=splits,
+                             map_output=sum(c for c, _ in map_results),
+                             reduce_output=sum(c for c, _ in reduce_results))
+        return self.outputs
+
+    def results(self):
+        ' Yields the results of the last run(), partition by partition '
+        for path in self.outputs:
+            with open(path, 'rb') as f:
+                for data in RecordReader(f):
+                    yield cPickle.loads(data)
+
+    def close(self):
+        if self._own_workdir:
+            shutil.rmtree(self._workdir, ignore_errors=True)
@@ -5,6 +5,17 @@ Created on Jan 16, 2012
 '''
 
 import string
+import bisect
+import zlib
+from array import array
+from itertools import imap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # partition_many() falls back to pure Python
+
+from vtil.randomtools import reservoir_sample
 
 class Partitioner(object):
     def __init__(self, bucket_count):
@@ -15,6 +26,35 @@ class Partitioner(object):
         return self._bucket_count
     def partition(self, key):
         raise NotImplementedError("Must subclass Partitioner and implement partition() function")
+    def partition_many(self, keys):
+        '''
+        Returns the bucket of each of *keys* as an array (a numpy array if NumPy
+        is installed, else an array.array). Subclasses may override this with a
+        faster, vectorized version.
+        '''
+        return _int_array(imap(self.partition, keys))
+
+def _int_array(values):
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.intp)
+    return array('l', values)
+
+def group_indices(buckets, bucket_count):
+    '''
+    Given the bucket of each key (e.g. from Partitioner.partition_many()),
+    returns a list holding, for each bucket, the indices of its keys in
+    ascending order.
+    '''
+    if numpy is not None:
+        buckets = numpy.asarray(buckets, dtype=numpy.intp)
+        order = numpy.argsort(buckets, kind='mergesort') # stable
+        counts = numpy.bincount(buckets, minlength=bucket_count)
+        return numpy.split(order, numpy.cumsum(counts)[:-1])
+    groups = [[] for _ in xrange(bucket_count)]
+    appends = [group.append for group in groups]
+    for i, bucket in enumerate(buckets):
+        appends[bucket](i)
+    return groups
 
 class HashPartitioner(Partitioner):
     ''' Partition to reducers based on the modulo hash of the ID string.
@@ -29,6 +69,68 @@ class HashPartitioner(Partitioner):
     def partition(self, key):
         return hash(key) % self._bucket_count
 
+_MASK64 = 2**64 - 1
+
+def _fmix64(h):
+    ' MurmurHash3 finalizer: spreads every input bit over the whole 64-bit result '
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & _MASK64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & _MASK64
+    h ^= h >> 33
+    return h
+
+def _key_bytes(key):
+    if isinstance(key, str):
+        return key
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    if isinstance(key, (int, long)):
+        return str(int(key)) # bools hash as 0 and 1
+    if isinstance(key, float):
+        return str(int(key)) if key.is_integer() else repr(key)
+    if isinstance(key, tuple):
+        return '(%s)' % ','.join('%016x' % stable_hash(k) for k in key)
+    raise TypeError("stable_hash() supports strings, numbers and tuples of them, not %s"
+                    % type(key).__name__)
+
+def stable_hash(key):
+    '''
+    Returns a 64-bit hash of *key* (a string, number or tuple of them) that is
+    the same in every process, build and interpreter, unlike hash(). As with
+    hash(), numbers that compare equal (1, 1.0 and True) hash the same.
+    '''
+    data = _key_bytes(key)
+    return _fmix64(((zlib.crc32(data) & 0xffffffff) << 32) | (zlib.adler32(data) & 0xffffffff))
+
+def jump_hash(key, bucket_count):
+    '''
+    Maps a 64-bit integer *key* to a bucket in [0, bucket_count) such that going
+    from n to n+1 buckets moves only 1/(n+1) of the keys, all to the new bucket
+    (Lamping and Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm").
+    '''
+    b, j = -1, 0
+    while j < bucket_count:
+        b = j
+        key = (key * 2862933555777941757 + 1) & _MASK64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+class StableHashPartitioner(Partitioner):
+    ''' Like HashPartitioner, but assignments are the same in every process
+    because they use stable_hash() rather than hash().
+    '''
+    def partition(self, key):
+        return stable_hash(key) % self._bucket_count
+
+class JumpHashPartitioner(Partitioner):
+    ''' Partition by jump consistent hashing of stable_hash(key), so that
+    changing the bucket count from n to m moves only about |m-n|/max(m,n) of
+    the keys, and assignments are the same in every process.
+    '''
+    def partition(self, key):
+        return jump_hash(stable_hash(key), self._bucket_count)
+
 char_lists = [string.ascii_letters, string.digits, string.punctuation, string.whitespace]
 all_chars = [c for clist in char_lists for c in clist]
 
@@ -65,3 +167,64 @@ class NumberPartitioner(Partitioner):
             raise ValueError("Key out of bounds for NumberPartitioner: %d" % key)
         return int(((key-self._low) / (self._high-self._low)) * self._bucket_count)
 
+    def partition_many(self, keys):
+        low, high, count = self._low, self._high, self._bucket_count
+        if numpy is not None:
+            keys = numpy.asarray(keys, dtype=numpy.float64)
+            if keys.size and (keys.min() < low or keys.max() >= high):
+                raise ValueError("Key out of bounds for NumberPartitioner")
+            return (((keys - low) / (high - low)) * count).astype(numpy.intp)
+        width = high - low
+        buckets = array('l')
+        append = buckets.append
+        for key in keys:
+            if key < low or key >= high:
+                raise ValueError("Key out of bounds for NumberPartitioner: %d" % key)
+            append(int(((key - low) / width) * count))
+        return buckets
+
+
+class RangePartitioner(Partitioner):
+    ''' Partition into the ranges between sorted split points.
+
+    Keys less than splits[0] go to bucket 0, keys in [splits[i-1], splits[i]) to
+    bucket i, and keys at or above splits[-1] to the last bucket, so bucket
+    order follows key order. Pickle the partitioner (or save its splits) to
+    partition the same way elsewhere.
+    '''
+    def __init__(self, splits):
+        splits = list(splits)
+        super(RangePartitioner, self).__init__(len(splits) + 1)
+        self._splits = splits
+        if any(a > b for a, b in zip(self._splits, self._splits[1:])):
+            raise ValueError("RangePartitioner splits must be sorted")
+
+    @property
+    def splits(self):
+        return tuple(self._splits)
+
+    @classmethod
+    def from_sample(cls, keys, bucket_count, sample_size=10000):
+        '''
+        Builds a RangePartitioner whose splits are quantiles of a reservoir
+        sample of *keys*, so buckets get roughly equal numbers of keys however
+        they are distributed.
+        '''
+        if bucket_count < 1:
+            raise ValueError("bucket_count must be at least 1")
+        sample = sorted(reservoir_sample(keys, sample_size))
+        if not sample:
+            raise ValueError("Cannot build a RangePartitioner from no keys")
+        return cls([sample[len(sample) * i // bucket_count] for i in xrange(1, bucket_count)])
+
+    def partition(self, key):
+        return bisect.bisect_right(self._splits, key)
+
+    def partition_many(self, keys):
+        if numpy is not None:
+            splits = numpy.asarray(self._splits)
+            if splits.dtype.kind in 'iuf': # numpy orders strings differently from Python
+                return numpy.searchsorted(splits, numpy.asarray(keys), side='right').astype(numpy.intp)
+        splits = self._splits
+        bisect_right = bisect.bisect_right
+        return _int_array(bisect_right(splits, key) for key in keys)
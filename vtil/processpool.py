@@ -0,0 +1,160 @@
+'''
+A process-backed counterpart of vtil.threadpool.ThreadPool, for CPU-bound
+functions that the GIL would otherwise serialize.
+
+Usage:
+    pool = ProcessPool(4, parse)    # was: ThreadPool(4, parse)
+    pool.map(lines, chunksize=256)
+    pool.start()
+    pool.join()
+    results = list(pool)
+'''
+
+import os
+import mmap
+import tempfile
+import collections
+import multiprocessing
+import Queue
+
+from vtil.iterator import chunks, _STOP, _picklable, _get_checked, _put_checked
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+class _SharedBytes(object):
+    ' A byte string handed between processes in a memory-backed file rather than a pipe '
+    __slots__ = ('path',)
+    def __init__(self, data):
+        fd, self.path = tempfile.mkstemp(prefix='vtil-', dir=SHM_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return ''
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return m[:]
+                finally:
+                    m.close()
+        finally:
+            os.unlink(self.path)
+
+def _share(data, threshold):
+    if threshold is not None and isinstance(data, str) and len(data) >= threshold:
+        return _SharedBytes(data)
+    return data
+
+def _unshare(data):
+    return data.load() if isinstance(data, _SharedBytes) else data
+
+class _Done(object):
+    ' The last message from each worker, which join() waits for '
+    def __init__(self, pid):
+        self.pid = pid
+
+def runner(inqueue, outqueue, func, shared_threshold):
+    try:
+        while True:
+            chunk = inqueue.get(block=True)
+            if chunk is _STOP: break
+            results = []
+            for data in chunk:
+                try:
+                    out = func(_unshare(data))
+                except KeyboardInterrupt:
+                    outqueue.put(results) # keep what this chunk already computed
+                    return
+                except Exception as e:
+                    results.append(_picklable(e, getattr(func, '__name__', 'func')))
+                else:
+                    results.append(_share(out, shared_threshold))
+            outqueue.put(results)
+    finally:
+        outqueue.put(_Done(os.getpid()))
+
+class ProcessPool(object):
+    '''
+    Runs *func* on data push()ed or map()ped into the pool from *num* worker
+    processes, which live until join(). Results (or the exceptions raised) are
+    collected by iterating over the pool once it is joined.
+
+    map() sends *chunksize* values per message to amortize pickling. Byte
+    strings of at least *shared_threshold* bytes, whether data or results, are
+    passed through a file in shared memory (/dev/shm where available) instead of
+    being pickled through a pipe.
+
+    *func*, data and results must be picklable, and *max_queued* bounds the
+    number of queued messages as for ThreadPool.
+
+    If a worker process dies (e.g. killed, or calling os._exit()), the work it
+    held is lost: join() still returns the other results, then raises
+    RuntimeError, and pushing raises RuntimeError once no worker is left.
+    '''
+    def __init__(self, num, func, max_queued=0, shared_threshold=None):
+        self._shared_threshold = shared_threshold
+        self._inqueue = multiprocessing.Queue(maxsize=max_queued)
+        self._outqueue = multiprocessing.Queue()
+        self._results = collections.deque()
+        self._processes = []
+        for _ in xrange(num):
+            process = multiprocessing.Process(target=runner,
+                    args=(self._inqueue, self._outqueue, func, shared_threshold))
+            process.daemon = True
+            self._processes.append(process)
+
+    def __iter__(self): return self
+    def next(self):
+        ' Returns a finished result, raising StopIteration if none is ready right now '
+        while not self._results:
+            try:
+                self._collect(self._outqueue.get(block=False))
+            except Queue.Empty:
+                raise StopIteration
+        return self._results.popleft()
+
+    def _collect(self, message):
+        ' Keeps the results in *message*, or returns the pid of the worker it says is done '
+        if isinstance(message, _Done):
+            return message.pid
+        self._results.extend(_unshare(result) for result in message)
+        return None
+
+    def push(self, data):
+        _put_checked(self._inqueue, [_share(data, self._shared_threshold)], self._processes)
+
+    def map(self, iterable, chunksize=1):
+        ' push() each value of *iterable*, *chunksize* values per message '
+        threshold = self._shared_threshold
+        for chunk in chunks(chunksize, iterable):
+            _put_checked(self._inqueue, [_share(data, threshold) for data in chunk], self._processes)
+
+    def join(self):
+        try:
+            [_put_checked(self._inqueue, _STOP, self._processes) for _ in self._processes]
+        except RuntimeError:
+            pass # every worker is dead, the remaining stops don't matter
+        # workers can't exit until their results are read from the pipe
+        running = dict((process.pid, process) for process in self._processes)
+        died = None
+        while running:
+            try:
+                running.pop(self._collect(_get_checked(self._outqueue, running.values())), None)
+            except RuntimeError as e: # some exited without a _Done, collect from the rest
+                died = e
+                for pid, process in running.items():
+                    if process.exitcode is not None:
+                        del running[pid]
+        [process.join() for process in self._processes]
+        failed = [process.exitcode for process in self._processes if process.exitcode]
+        if failed:
+            raise RuntimeError('%d ProcessPool worker(s) died (exit codes %s), their work is lost'
+                               % (len(failed), ', '.join(map(str, failed))))
+        if died is not None:
+            raise died
+
+    def start(self):
+        for process in self._processes:
+            process.start()
@@ -21,3 +21,15 @@ for l in product((True, False), repeat=5):
 def random_string(length, uppercase=True, lowercase=True, digits=False, punctuation=False, whitespace=False):
     sig = (uppercase, lowercase, digits, punctuation, whitespace)
     return ''.join([_random.choice(char_bins[sig]) for _ in xrange(length)])
+
+def reservoir_sample(iterable, k, random=_random):
+    ' Returns a uniform random sample of up to *k* values from *iterable* in one pass '
+    sample = []
+    for i, value in enumerate(iterable):
+        if i < k:
+            sample.append(value)
+        else:
+            j = random.randint(0, i)
+            if j < k:
+                sample[j] = value
+    return sample
@@ -79,3 +79,15 @@ class RangeReader(object):
                 return False
             else:
                 return True
+
+def split_ranges(size, count):
+    '''
+    Splits *size* bytes into *count* contiguous (start, end) ranges of nearly
+    equal length.
+
+    split_ranges(10, 3) --> [(0, 3), (3, 6), (6, 10)]
+    '''
+    if count < 1:
+        raise ValueError('split_ranges: count must be positive (got %d)' % count)
+    bounds = [size * i // count for i in xrange(count + 1)]
+    return zip(bounds[:-1], bounds[1:])
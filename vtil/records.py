@@ -6,6 +6,11 @@ Created on Jan 18, 2012
 
 import os
 import re
+import mmap
+import multiprocessing
+import struct
+import zlib
+import time
 import cPickle
 import tempfile
 import shutil
@@ -15,11 +20,35 @@ from contextlib import contextmanager
 from collections import deque
 
 from vtil import exception
-from vtil.transaction import TransactionReader
+from vtil.rangereader import RangeReader, split_ranges
+from vtil.iterator import parallel_map
 
+# Every record starts with SENTINEL. Version 1 records follow it with the
+# pickled length of the data (with '#' escaped as '##'), the escaped data and the
+# pickled hash() of the escaped data. Version 2 records follow it with a '\x02'
+# version byte, a binary header of data length, CRC32 of the data and CRC32 of
+# the header, then the unescaped data and a '.' (so that, as with version 1, the
+# byte before a sentinel is never an escaping '#'). Blocks are framed the same
+# way with a '\x03' byte, and their data is a zlib-compressed run of records,
+# each preceded by its length.
 SENTINEL = '#S'
+DEFAULT_VERSION = 1
+_V2 = '\x02'
+_BLOCK = '\x03'
+_FRAME_LENGTHS = struct.Struct('<II') # data length, data crc
+_FRAME_HEADER = struct.Struct('<III') # data length, data crc, header crc
+_FRAME_END = '.'
+_BLOCK_RECORD_LENGTH = struct.Struct('<I')
+
+# Index entries locate a record by the offset and length of its frame (record
+# or block), and its position within that frame (0 except for blocks).
+INDEX_ENTRY = struct.Struct('<QQI')
+_CRC_MASK = 0xffffffff
 KB = 2 ** 10
-READ_BUFFER_SIZE = 32 * KB
+MB = 2 ** 20
+READ_BUFFER_SIZE = 1 * MB
+DEFAULT_BLOCK_SIZE = 64 * KB
+DEFAULT_RANGE_SIZE = 16 * MB # bytes per ParallelRecordReader task
 
 # when scanning look for #S, but NOT ##S
 # find_sentinel('abc12##Sjeoht38#SoSo') --> match(16, 18)
@@ -44,11 +73,50 @@ class _write_only(object):
         self._stream = stream
         self.write = stream.write
 
+class _chunks(list):
+    write = list.append
+
+def _write_frame(stream, kind, chunks):
+    length = 0
+    crc = 0
+    for chunk in chunks:
+        length += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+    header = SENTINEL + kind + _FRAME_LENGTHS.pack(length, crc & _CRC_MASK)
+    stream.write(header + struct.pack('<I', zlib.crc32(header) & _CRC_MASK))
+    for chunk in chunks:
+        stream.write(chunk)
+    stream.write(_FRAME_END)
+
 @contextmanager
-def RecordWriter(stream):
-    buffer = StringIO()
-    yield _write_only(buffer)
-    if buffer.tell():
+def RecordWriter(stream, version=DEFAULT_VERSION, index=None):
+    '''
+    Collects writes into a single record, which is written to *stream* on exit
+    (if anything was written).
+
+    Version 2 records are written as they are, with no escaping, and checked
+    with CRC32 (stable across builds, unlike the hash() of version 1). Readers
+    detect the version of each record.
+
+    If *index* is given, an entry for the record is appended to that file (see
+    RecordIndex). *stream* must then support tell().
+    '''
+    if version not in (1, 2):
+        raise ValueError('RecordWriter: unknown record version %r' % version)
+
+    if version == 2:
+        chunks = _chunks()
+        yield _write_only(chunks)
+        if not chunks:
+            return
+        offset = stream.tell() if index is not None else None
+        _write_frame(stream, _V2, chunks)
+    else:
+        buffer = StringIO()
+        yield _write_only(buffer)
+        if not buffer.tell():
+            return
+        offset = stream.tell() if index is not None else None
         buffer = buffer.getvalue()
         buffer = fix_write(buffer) # replace sentinels
         stream.write(SENTINEL)
@@ -56,8 +124,90 @@ def RecordWriter(stream):
         stream.write(buffer)
         cPickle.dump(hash(buffer), stream, cPickle.HIGHEST_PROTOCOL)
 
+    if index is not None:
+        index.write(INDEX_ENTRY.pack(offset, stream.tell() - offset, 0))
+
+class RecordBlockWriter(object):
+    '''
+    Writes records to *stream* in zlib-compressed, checksummed blocks, which
+    readers expand back into the individual records.
+
+    A block is written once the records in it add up to *block_size* bytes or,
+    if *flush_interval* is given, once its first record is that many seconds
+    old. The age is checked on each write, so a stream that goes quiet leaves
+    its last block buffered: call maybe_flush() periodically (e.g. from an
+    event loop's timeout) to bound how stale the stream can get. flush() and
+    close() write out any partial block. *level* is the zlib compression level.
+
+    If *index* is given, an entry for each record is appended to that file (see
+    RecordIndex). *stream* must then support tell().
+
+    Usage:
+        with RecordBlockWriter(stream) as writer:
+            for record in records:
+                writer.write(record)
+    '''
+    def __init__(self, stream, block_size=DEFAULT_BLOCK_SIZE, flush_interval=None, level=6, index=None):
+        self._stream = stream
+        self._index = index
+        self._block_size = block_size
+        self._flush_interval = flush_interval
+        self._level = level
+        self._chunks = []
+        self._size = 0
+        self._started = None
+
+    def __enter__(self): return self
+    def __exit__(self, et, ev, tb):
+        self.close()
+        return False
+
+    def write(self, record):
+        ' Adds *record* to the current block '
+        if not self._chunks:
+            self._started = time.time()
+        self._chunks.append(_BLOCK_RECORD_LENGTH.pack(len(record)))
+        self._chunks.append(record)
+        self._size += len(record)
+        if self._size >= self._block_size:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        '''
+        Writes out the current block if it is older than *flush_interval*,
+        returning True if it did. Does nothing without a *flush_interval*.
+        '''
+        if (self._chunks and self._flush_interval is not None
+                and time.time() - self._started >= self._flush_interval):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        ' Writes out the current block, if any '
+        if self._chunks:
+            data = zlib.compress(''.join(self._chunks), self._level)
+            offset = self._stream.tell() if self._index is not None else None
+            _write_frame(self._stream, _BLOCK, [data])
+            if self._index is not None:
+                length = self._stream.tell() - offset
+                self._index.write(''.join(INDEX_ENTRY.pack(offset, length, i)
+                                          for i in xrange(len(self._chunks) // 2)))
+            self._chunks = []
+            self._size = 0
+        if hasattr(self._stream, 'flush'):
+            self._stream.flush()
+
+    def close(self):
+        self.flush()
+
 class _HashFail(Exception): pass
 class _NoSentinel(Exception): pass
+class _BadPickle(Exception): pass
+class _BadHeader(Exception): pass
+class _Incomplete(Exception): pass
 class RecordReadError(Exception): pass
 
 def DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error):
@@ -67,38 +217,429 @@ def DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error):
         raise RecordReadError
     else:
         return
- 
-def RecordReader(stream, tolerate_pre_error=True, tolerate_subsequent_error=False):
-    got_first = False
-    reader = TransactionReader(stream)
-    while True:
-        # wind reader to just past first sentinel
+
+# lengths and hashes are ints pickled with protocol 2:
+#   '\x80\x02' <opcode> <argument> '.'
+_PICKLE_PROTO = '\x80\x02'
+_PICKLE_STOP = '.'
+_pickled_int_formats = {
+    'K': struct.Struct('<B'), # BININT1
+    'M': struct.Struct('<H'), # BININT2
+    'J': struct.Struct('<i'), # BININT
+}
+_MAX_PICKLED_INT = 32 # generous upper bound on the size of a pickled hash
+
+def _load_int(buf, pos, end):
+    '''
+    Decodes an int pickled by cPickle.dump() at buf[pos:end], in place. Returns
+    (value, pos) where pos is just past the pickle.
+    '''
+    if pos + 3 > end:
+        raise _Incomplete(pos + _MAX_PICKLED_INT)
+    if buf[pos:pos+2] != _PICKLE_PROTO:
+        raise _BadPickle
+    opcode = str(buf[pos+2:pos+3])
+    pos += 3
+    if opcode in _pickled_int_formats:
+        fmt = _pickled_int_formats[opcode]
+        if pos + fmt.size + 1 > end:
+            raise _Incomplete(pos + fmt.size + 1)
+        value, = fmt.unpack_from(buf, pos)
+        pos += fmt.size
+    elif opcode == 'I': # INT: decimal text, for ints that do not fit in 32 bits
+        newline = buf.find('\n', pos, min(end, pos + _MAX_PICKLED_INT))
+        if newline < 0:
+            if end < pos + _MAX_PICKLED_INT:
+                raise _Incomplete(pos + _MAX_PICKLED_INT)
+            raise _BadPickle
+        try:
+            value = int(str(buf[pos:newline]))
+        except ValueError:
+            raise _BadPickle
+        pos = newline + 1
+    elif opcode == '\x8a': # LONG1: little-endian two's complement
+        if pos + 1 > end:
+            raise _Incomplete(pos + 1)
+        size = ord(buf[pos:pos+1])
+        if pos + 1 + size + 1 > end:
+            raise _Incomplete(pos + 1 + size + 1)
+        value = cPickle.loads(_PICKLE_PROTO + '\x8a' + str(buf[pos:pos+1+size]) + _PICKLE_STOP)
+        pos += 1 + size
+    else:
+        raise _BadPickle
+    if pos + 1 > end:
+        raise _Incomplete(pos + 1)
+    if buf[pos:pos+1] != _PICKLE_STOP:
+        raise _BadPickle
+    return value, pos + 1
+
+def _load_frame(buf, pos, end):
+    ' Checks the frame whose header is at buf[pos:end], returns (data, pos) '
+    data_start = pos + _FRAME_HEADER.size
+    if data_start > end:
+        raise _Incomplete(data_start)
+    length, data_crc, header_crc = _FRAME_HEADER.unpack_from(buf, pos)
+    header = buffer(buf, pos - len(SENTINEL) - 1, len(SENTINEL) + 1 + _FRAME_LENGTHS.size)
+    if zlib.crc32(header) & _CRC_MASK != header_crc:
+        raise _BadHeader
+    data_end = data_start + length
+    if data_end + len(_FRAME_END) > end:
+        raise _Incomplete(data_end + len(_FRAME_END))
+    data = buffer(buf, data_start, length)
+    if zlib.crc32(data) & _CRC_MASK != data_crc or buf[data_end:data_end+1] != _FRAME_END:
+        raise _HashFail
+    return data, data_end + len(_FRAME_END)
+
+class _Block(list): pass
+
+def _load_block(data, copy):
+    ' Expands the (compressed) data of a block into a _Block of its records '
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        raise _HashFail
+    block = _Block()
+    pos = 0
+    end = len(data)
+    size = _BLOCK_RECORD_LENGTH.size
+    while pos < end:
+        if pos + size > end:
+            raise _HashFail
+        length, = _BLOCK_RECORD_LENGTH.unpack_from(data, pos)
+        pos += size
+        block.append(data[pos:pos+length] if copy else buffer(data, pos, length))
+        pos += length
+    if pos != end:
+        raise _HashFail
+    return block
+
+def _load_record(buf, pos, end, copy=True):
+    '''
+    Decodes the record following a sentinel at buf[pos:end], returns (record,
+    pos). For blocks, record is a _Block of records.
+    '''
+    if pos + 1 > end:
+        raise _Incomplete(pos + 1)
+    kind = buf[pos:pos+1]
+    if kind == _V2:
+        data, pos = _load_frame(buf, pos + 1, end)
+        return (str(data) if copy else data), pos
+    elif kind == _BLOCK:
+        data, pos = _load_frame(buf, pos + 1, end)
+        return _load_block(data, copy), pos
+
+    length, pos = _load_int(buf, pos, end)
+    if length < 0:
+        raise _BadPickle
+    data_start = pos
+    data_end = pos + length
+    if data_end > end:
+        raise _Incomplete(data_end + _MAX_PICKLED_INT)
+    data_hash, pos = _load_int(buf, data_end, end)
+    data = str(buf[data_start:data_end]) # the only copy of the payload
+    if data_hash != hash(data):
+        raise _HashFail
+    if '#' in data:
+        data = data.replace('##', '#') # fix_read(), without the regex
+    return data, pos
+
+def _escaped(buf, start):
+    ' Returns True if the sentinel at buf[start] looks like an escaped one '
+    return start > 0 and buf[start-1:start] == '#'
+
+class RecordScanner(object):
+    '''
+    Finds and decodes records in a buffer of data written by RecordWriter.
+
+    The buffer can be a str, bytearray or mmap, which is scanned in place:
+    sentinels are located with find() and records are decoded straight out of
+    the buffer. Alternatively, stream data can be feed()-ed in blocks. Blocks
+    are held back in a list until they can complete the pending record, so a
+    large record fed in small blocks is not copied again for every block.
+
+    If *copy* is False, version 2 records are returned as buffer objects
+    referencing the scanned data rather than as copies.
+
+    Usage:
+        scanner = RecordScanner()
+        scanner.feed(block1)
+        for offset, record in scanner.scan():
+            ...
+        scanner.feed(block2)
+        for offset, record in scanner.scan(final=True): # no more data
+            ...
+    '''
+    def __init__(self, buf='', pos=0, offset=0, tolerate_pre_error=True,
+                 tolerate_subsequent_error=False, copy=True):
+        self._buf = buf
+        self._copy = copy
+        self._pos = pos
+        self._base = offset # stream offset of self._buf[0]
+        self._want = 0 # buffer size needed to complete the pending record
+        self._pending = [] # fed blocks not yet appended to self._buf
+        self._pending_size = 0
+        self.stopped = False
+        self._tolerate_pre_error = tolerate_pre_error
+        self._tolerate_subsequent_error = tolerate_subsequent_error
+        self.got_first = False
+
+    def feed(self, data):
+        ' Appends data to the buffer, dropping data that has already been scanned '
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+    def _append_pending(self):
+        drop = max(self._pos - 1, 0) # keep a byte to check for escaped sentinels
+        self._buf = self._buf[drop:] + ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._base += drop
+        self._want -= drop
+        self._pos -= drop
+
+    def wanted(self):
+        ' Returns the number of bytes needed to complete the pending record (0 if unknown) '
+        return max(self._want - len(self._buf) - self._pending_size, 0)
+
+    def tell(self):
+        ' Returns the stream offset up to which data has been scanned '
+        return self._base + self._pos
+
+    def _dumped(self):
+        DumpedData(self.got_first, self._tolerate_pre_error, self._tolerate_subsequent_error)
+
+    def scan(self, final=False, stop=None):
+        '''
+        Yields (offset, record) for each record in the buffer, where offset is
+        the stream offset of the record's sentinel.
+
+        Unless *final* is True, stops at the first incomplete record (which the
+        next feed() may complete). If *stop* is given, also stops at the first
+        sentinel at or after that stream offset, setting self.stopped.
+        '''
+        if self._pending:
+            if not final and self.wanted():
+                return # the pending record is still incomplete
+            self._append_pending()
+        buf = self._buf
+        end = len(buf)
+        self._want = 0
+        # buffer index of stop, data from there on is left to another reader
+        stop = end + 1 if stop is None else stop - self._base
         while True:
-            with reader:
-                block = reader.read(READ_BUFFER_SIZE)
-                if not block:
-                    return # eof
-                match = find_sentinel(block)
-                if not match:
-                    DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
-                    reader.commit()
-                else:
-                    if match.start() > 0:
-                        DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
-                    reader.commit(match.end())
-                    break
-
-        # do the read
-        with reader:
+            pos = self._pos
+            if pos > stop:
+                self.stopped = True
+                return
+            start = buf.find(SENTINEL, pos)
+            while _escaped(buf, start):
+                start = buf.find(SENTINEL, start + 1)
+            if start < 0:
+                # keep a tail that may turn out to be (escaping) a sentinel
+                keep = 0 if final else min(len(SENTINEL), end - pos)
+                if end - keep > pos and pos < stop:
+                    self._dumped()
+                self._pos = end - keep
+                self.stopped = self._pos > stop
+                return
+            if start >= stop and (start > stop or not _escaped(buf, start)):
+                # left for a reader starting at stop (which takes a record
+                # there unless it would mistake it for an escaped sentinel)
+                if start > pos and pos < stop:
+                    self._dumped()
+                self._pos = start
+                self.stopped = True
+                return
+            if start > pos:
+                self._dumped()
+            self._pos = start
+
+            try:
+                record, pos = _load_record(buf, start + len(SENTINEL), end, self._copy)
+            except _Incomplete as e:
+                if not final:
+                    self._want = e.args[0]
+                    return
+                self._dumped() # truncated
+                self._pos = start + len(SENTINEL)
+                continue
+            except (_BadPickle, _BadHeader, _HashFail):
+                self._dumped()
+                self._pos = start + len(SENTINEL)
+                continue
+
+            self._pos = pos
+            self.got_first = True
+            if type(record) is _Block:
+                for block_record in record:
+                    yield self._base + start, block_record
+            else:
+                yield self._base + start, record
+
+def _scan_stream(stream, scanner, stop=None):
+    ' Feeds *scanner* from *stream*, yielding (offset, record) '
+    while True:
+        block = stream.read(max(READ_BUFFER_SIZE, scanner.wanted()))
+        scanner.feed(block)
+        for item in scanner.scan(final=not block, stop=stop):
+            yield item
+        if not block or scanner.stopped:
+            return
+
+def RecordReader(stream, tolerate_pre_error=True, tolerate_subsequent_error=False, copy=True):
+    scanner = RecordScanner(tolerate_pre_error=tolerate_pre_error,
+                            tolerate_subsequent_error=tolerate_subsequent_error,
+                            copy=copy)
+    for _, record in _scan_stream(stream, scanner):
+        yield record
+
+def MappedRecordReader(file_obj, tolerate_pre_error=True, tolerate_subsequent_error=False, copy=True):
+    '''
+    RecordReader for regular files. Reads from the current position of
+    *file_obj* by scanning the file in place through mmap.
+
+    If *copy* is False, version 2 records are yielded as buffer objects into the
+    mapped file, which stays mapped until they have all been released.
+    '''
+    pos = file_obj.tell()
+    if pos >= os.fstat(file_obj.fileno()).st_size:
+        return # nothing to read (and empty files cannot be mapped)
+    mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        scanner = RecordScanner(mapped, pos, tolerate_pre_error=tolerate_pre_error,
+                                tolerate_subsequent_error=tolerate_subsequent_error,
+                                copy=copy)
+        for _, record in scanner.scan(final=True):
+            yield record
+    finally:
+        if copy:
+            mapped.close()
+
+def RangeRecordReader(file_obj, start, end=None, tolerate_subsequent_error=False):
+    '''
+    Reads the records of a seekable *file_obj* whose sentinels lie in the byte
+    range [*start*, *end*).
+
+    Reading resyncs to the first sentinel at or after *start*, and a record
+    that straddles *end* is read to completion. Ranges that split up a file
+    therefore read each of its records exactly once, as long as no version 2
+    payload itself contains a record frame: version 2 payloads are not
+    escaped, so a reader starting inside one cannot tell an embedded frame
+    from a real one. (Version 1 payloads are escaped and always safe.)
+    '''
+    # start a byte early so an escaped sentinel is recognized as such
+    skip = 1 if start > 0 else 0
+    reader = RangeReader(file_obj, start - skip)
+    scanner = RecordScanner(reader.read(skip), skip, start - skip,
+                            tolerate_subsequent_error=tolerate_subsequent_error)
+    for _, record in _scan_stream(reader, scanner, stop=end):
+        yield record
+
+def _read_range(args):
+    path, start, end, tolerate_subsequent_error = args
+    with open(path, 'rb') as f:
+        return list(RangeRecordReader(f, start, end, tolerate_subsequent_error))
+
+def ParallelRecordReader(path, processes=None, ranges=None, ordered=True, tolerate_subsequent_error=False,
+                         range_size=DEFAULT_RANGE_SIZE, max_inflight=None):
+    '''
+    Reads the records in the file at *path* using a pool of *processes* worker
+    processes (one per CPU by default), each of which reads a byte range of the
+    file with RangeRecordReader and sends its records back in one batch.
+
+    The file is split into ranges of at most *range_size* bytes (or into
+    *ranges* ranges, if given), and at least one per process. At most
+    *max_inflight* ranges (default: twice the number of processes) are read
+    ahead of the consumer, so memory use is bounded by about
+    max_inflight * range_size however large the file. If *ordered* is False,
+    the records of each range are yielded as soon as the range is read,
+    otherwise records are yielded in file order. If a worker process dies
+    (e.g. killed for running out of memory), RuntimeError is raised.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    size = os.path.getsize(path)
+    ranges = ranges or max(processes, -(-size // range_size))
+    tasks = ((path, start, end, tolerate_subsequent_error)
+             for start, end in split_ranges(size, ranges))
+    for records in parallel_map(_read_range, tasks, workers=processes, max_inflight=max_inflight,
+                                ordered=ordered, backend='process'):
+        for record in records:
+            yield record
+
+class RecordIndex(object):
+    '''
+    The index of a record file, as written alongside it by RecordWriter or
+    RecordBlockWriter, or rebuilt with build_index().
+
+    The entries are kept as one packed string (20 bytes per record), and
+    index[n] returns the (offset, length, position) entry of record n.
+
+    Usage:
+        index = RecordIndex(index_file)
+        last_ten = list(IndexedRecordReader(stream, index, len(index) - 10))
+        for start, stop in index.split(4): # split work by record count
+            ...
+    '''
+    def __init__(self, index_file):
+        self._entries = index_file.read()
+        self._count = len(self._entries) // INDEX_ENTRY.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError('record %d not in index of %d records' % (n, self._count))
+        return INDEX_ENTRY.unpack_from(self._entries, n * INDEX_ENTRY.size)
+
+    def __iter__(self):
+        return (self[n] for n in xrange(self._count))
+
+    def split(self, count):
+        ' Splits the records into *count* (start, stop) ranges of record numbers '
+        return split_ranges(self._count, count)
+
+def build_index(stream, index):
+    '''
+    Scans the records in *stream* in one pass, appending their entries to the
+    file *index*. Corrupt data is skipped. Returns the number of records.
+    '''
+    scanner = RecordScanner(tolerate_subsequent_error=True)
+    count = 0
+    last_offset = None
+    position = 0
+    for offset, _ in _scan_stream(stream, scanner):
+        position = position + 1 if offset == last_offset else 0
+        index.write(INDEX_ENTRY.pack(offset, scanner.tell() - offset, position))
+        last_offset = offset
+        count += 1
+    return count
+
+def IndexedRecordReader(stream, index, start=0, stop=None):
+    '''
+    Reads records *start* up to (but not including) *stop* of the seekable
+    *stream*, jumping straight to them using *index* (a RecordIndex).
+
+    Raises RecordReadError if a record cannot be read where the index says.
+    '''
+    stop = len(index) if stop is None else min(stop, len(index))
+    frame = None
+    for n in xrange(start, stop):
+        offset, length, position = index[n]
+        if frame is None or frame[0] != offset:
+            stream.seek(offset)
+            buf = stream.read(length)
             try:
-                length = cPickle.load(reader)
-                data = reader.read(length)
-                data_hash = cPickle.load(reader)
-                if data_hash != hash(data) or length != len(data):
-                    raise _HashFail
-                data = fix_read(data)
-                reader.commit()
-                got_first = True
-                yield data
-            except (EOFError, cPickle.UnpicklingError, _HashFail):
-                DumpedData(got_first, tolerate_pre_error, tolerate_subsequent_error)
+                if not buf.startswith(SENTINEL):
+                    raise _BadHeader
+                record, _ = _load_record(buf, len(SENTINEL), len(buf))
+            except (_Incomplete, _BadPickle, _BadHeader, _HashFail):
+                raise RecordReadError('record %d not found at offset %d' % (n, offset))
+            frame = offset, record
+        record = frame[1]
+        if type(record) is _Block:
+            yield record[position]
+        else:
+            yield record
@@ -0,0 +1,213 @@
+'''
+The map side of a shuffle: partitions a stream of key-value pairs into one
+output file per bucket.
+
+Usage:
+    files = [open('part-%05d' % i, 'wb') for i in xrange(16)]
+    with ShuffleWriter(StableHashPartitioner(16), files.__getitem__) as shuffle:
+        shuffle.write_pairs(pairs)
+    [f.close() for f in files]
+    ...
+    for key, value in read_bucket(open('part-00003', 'rb')):
+        ...
+'''
+
+import sys
+import heapq
+import cPickle
+import tempfile
+import operator
+import itertools
+
+from vtil.sorting import DEFAULT_MAX_MEM, make_wrap_funcs
+from vtil.records import RecordWriter, RecordReader
+from vtil.indexed import IndexedKVReader, write_sorted_kv
+from vtil.iterator import chunks
+
+FORMATS = ('records', 'indexed')
+_BATCH_SIZE = 1024 # pairs partitioned per partition_many() call, and pickled per spilled batch
+
+class ShuffleWriter(object):
+    '''
+    Buffers key-value pairs per bucket of *partitioner* and writes them to the
+    file object open_bucket(bucket), which is called once for each bucket
+    (even empty ones) and is not closed by the ShuffleWriter.
+
+    When the buffered pairs exceed *max_mem* (estimated as for
+    iterator.mem_chunks), the largest buffers are flushed first until half the
+    budget is free, so writes reach disk in large runs.
+
+    With format='records', each pair is written as a pickled (key, value)
+    record (see vtil.records). If *sort* is True, each bucket is sorted by
+    *key* (applied to the pair's key): flushed buffers become sorted runs,
+    which are merged into the bucket at close(). With format='indexed', each
+    bucket is an IndexedKV file, which is always sorted by key, so buckets are
+    spilled and merged the same way and *max_mem* bounds memory use as well.
+    Sorted runs of every bucket are appended to a single temporary file, so a
+    ShuffleWriter holds at most one file descriptor besides the buckets.
+
+    If a *combiner* is given, each flushed buffer is grouped by key and the
+    pairs of each key replaced with (key, value) for each value in
+    combiner(key, values), e.g. lambda key, values: [sum(values)]. This cuts
+    what reaches disk when keys repeat, but a key may still appear in several
+    flushed runs, so combiners must be safe to apply more than once.
+
+    Read buckets back with read_bucket().
+    '''
+    def __init__(self, partitioner, open_bucket, max_mem=DEFAULT_MAX_MEM,
+                 format='records', sort=False, key=None, combiner=None):
+        if format not in FORMATS:
+            raise ValueError("format must be one of %s" % ', '.join(FORMATS))
+        if format == 'indexed' and key is not None:
+            raise ValueError("IndexedKV buckets can only be sorted by the keys themselves")
+        self._partitioner = partitioner
+        self._open_bucket = open_bucket
+        self._max_mem = max_mem
+        self._format = format
+        self._sort = sort or format == 'indexed'
+        self._key = key
+        self._combiner = combiner
+        count = len(partitioner)
+        self._buffers = [[] for _ in xrange(count)]
+        self._sizes = [0] * count
+        self._mem = 0
+        self._outputs = [None] * count
+        self._spill_file = None
+        self._runs = [[] for _ in xrange(count)] # (start, end) offsets in _spill_file
+        self.counts = [0] * count
+
+    def __enter__(self): return self
+    def __exit__(self, et, ev, tb):
+        if et is None:
+            self.close()
+        return False
+
+    def write(self, key, value):
+        self._add(self._partitioner(key), key, value)
+        if self._mem > self._max_mem:
+            self._spill()
+
+    def write_pairs(self, pairs):
+        ' Writes each (key, value) in *pairs*, partitioning keys in batches '
+        for batch in chunks(_BATCH_SIZE, pairs):
+            buckets = self._partitioner.partition_many([k for k, _ in batch])
+            for bucket, (key, value) in itertools.izip(buckets, batch):
+                self._add(int(bucket), key, value)
+            if self._mem > self._max_mem:
+                self._spill()
+
+    def _add(self, bucket, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        self._buffers[bucket].append((key, value))
+        self._sizes[bucket] += size
+        self._mem += size
+        self.counts[bucket] += 1
+
+    def _spill(self):
+        ' Flush the largest buffers until at most half of max_mem is in use '
+        by_size = sorted(xrange(len(self._sizes)), key=self._sizes.__getitem__, reverse=True)
+        for bucket in by_size:
+            if self._mem <= self._max_mem // 2 or not self._sizes[bucket]:
+                break
+            self._flush(bucket)
+
+    def _output(self, bucket):
+        if self._outputs[bucket] is None:
+            self._outputs[bucket] = self._open_bucket(bucket)
+        return self._outputs[bucket]
+
+    def _take(self, bucket):
+        ' Removes and returns the buffered pairs of *bucket*, combined if there is a combiner '
+        pairs = self._buffers[bucket]
+        self._buffers[bucket] = []
+        self._mem -= self._sizes[bucket]
+        self._sizes[bucket] = 0
+        if self._combiner is not None and pairs:
+            pairs = self._combine(pairs)
+        return pairs
+
+    def _flush(self, bucket):
+        pairs = self._take(bucket)
+        if self._sort:
+            self._runs[bucket].append(self._write_run(sorted(pairs, key=self._pair_key())))
+        else:
+            self._write_out(bucket, pairs)
+
+    def _write_run(self, pairs):
+        ' Appends sorted *pairs* to the spill file in pickled batches, returning their offsets '
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        f = self._spill_file
+        f.seek(0, 2)
+        start = f.tell()
+        for batch in chunks(_BATCH_SIZE, pairs):
+            cPickle.dump(batch, f, cPickle.HIGHEST_PROTOCOL)
+        return start, f.tell()
+
+    def _read_run(self, start, end):
+        ' Yields the pairs of a run, seeking before each batch as runs are read in turn '
+        f = self._spill_file
+        pos = start
+        while pos < end:
+            f.seek(pos)
+            batch = cPickle.load(f)
+            pos = f.tell()
+            for pair in batch:
+                yield pair
+
+    def _merged(self, bucket):
+        ' Yields the pairs of *bucket*, buffered and spilled, in sorted order '
+        key = self._pair_key()
+        runs = [self._read_run(start, end) for start, end in self._runs[bucket]]
+        runs.append(sorted(self._take(bucket), key=key))
+        self._runs[bucket] = []
+        if len(runs) == 1:
+            return iter(runs[0])
+        wrap, unwrap = make_wrap_funcs(key=key)
+        return itertools.imap(unwrap, heapq.merge(*[itertools.imap(wrap, run) for run in runs]))
+
+    def _combine(self, pairs):
+        combiner = self._combiner
+        combined = []
+        pairs.sort(key=operator.itemgetter(0))
+        for key, group in itertools.groupby(pairs, operator.itemgetter(0)):
+            values = itertools.imap(operator.itemgetter(1), group)
+            combined.extend((key, value) for value in combiner(key, values))
+        return combined
+
+    def _pair_key(self):
+        if self._key is None:
+            return operator.itemgetter(0)
+        key = self._key
+        return lambda pair: key(pair[0])
+
+    def _write_out(self, bucket, pairs):
+        output = self._output(bucket)
+        dumps = cPickle.dumps
+        for pair in pairs:
+            with RecordWriter(output, version=2) as r:
+                r.write(dumps(pair, cPickle.HIGHEST_PROTOCOL))
+
+    def close(self):
+        try:
+            for bucket in xrange(len(self._buffers)):
+                if self._format == 'indexed':
+                    write_sorted_kv(self._output(bucket), self._merged(bucket))
+                    continue
+                if self._sort:
+                    self._write_out(bucket, self._merged(bucket))
+                elif self._buffers[bucket]:
+                    self._flush(bucket)
+                self._output(bucket).flush()
+        finally:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+def read_bucket(stream, format='records'):
+    ' Yields the (key, value) pairs of a bucket written by ShuffleWriter '
+    if format == 'indexed':
+        return iter(IndexedKVReader(stream))
+    if format == 'records':
+        return itertools.imap(cPickle.loads, RecordReader(stream))
+    raise ValueError("format must be one of %s" % ', '.join(FORMATS))
@@ -4,54 +4,341 @@ Created on Jan 15, 2012
 @author: vsekhar
 '''
 
+import sys
+import time
 import threading
 import Queue
+import collections
+
+from vtil.iterator import chunks
 
 STOP = object()
 
-def runner(inqueue, outqueue, func):
+class CancelledError(Exception): pass
+
+class Future(object):
+    '''
+    The pending result of a call submitted to a ThreadPool.
+
+    result() waits for the call to finish and returns its value, or re-raises
+    the exception it raised with its original traceback.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._state = 'pending'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _start(self):
+        ' Called by the worker: returns False if the future was cancelled '
+        with self._lock:
+            if self._state != 'pending':
+                return False
+            self._state = 'running'
+            return True
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._state = 'finished'
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self):
+        ' Cancel the call if it has not started, returning True if it was cancelled '
+        with self._lock:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+            self._exc_info = (CancelledError, CancelledError(), None)
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, fn):
+        ' Call fn(future) once the future is finished, from the worker thread '
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Queue.Empty('future not finished after %s seconds' % timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Queue.Empty('future not finished after %s seconds' % timeout)
+        if self._exc_info is not None:
+            exc_type, exc_value, tb = self._exc_info
+            raise exc_type, exc_value, tb
+        return self._result
+
+def _map_chunk(func, chunk):
+    return [func(data) for data in chunk]
+
+def _run_item(outqueue, future, func, args, kwargs):
+    ' Runs one work item, returning False if the worker should stop '
+    if future is not None and not future._start():
+        return True # cancelled
+    try:
+        out = func(*args, **kwargs)
+    except KeyboardInterrupt:
+        return False
+    except Exception as e:
+        if future is None: outqueue.put(e)
+        else: future._finish(exc_info=sys.exc_info())
+    else:
+        if future is None: outqueue.put(out)
+        else: future._finish(out)
+    return True
+
+def runner(inqueue, outqueue):
+    '''
+    Work items arrive in lists, so a batch of small tasks costs one queue
+    operation. Results of push()ed data go to *outqueue*, results of submit()ted
+    calls to their futures.
+    '''
     while True:
-        data = inqueue.get(block=True)
-        if data is STOP: break
-        try:
-            out = func(data)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            outqueue.put(e)
-        else:
-            outqueue.put(out)
+        batch = inqueue.get(block=True)
+        if batch is STOP: break
+        for item in batch:
+            if not _run_item(outqueue, *item):
+                return
+
+def instrumented_runner(inqueue, outqueue, worker, stats):
+    ' Like runner(), but batches arrive as (enqueue time, batch) and timings are recorded '
+    clock = time.time
+    while True:
+        idle_start = clock()
+        batch = inqueue.get(block=True)
+        start = clock()
+        worker.idle += start - idle_start
+        if batch is STOP: break
+        enqueued, batch = batch
+        for item in batch:
+            stats.wait_times.append(start - enqueued)
+            ok = _run_item(outqueue, *item)
+            end = clock()
+            stats.run_times.append(end - start)
+            worker.busy += end - start
+            worker.tasks += 1
+            start = end
+            if not ok:
+                return
+
+def _percentiles(samples, points=(50, 90, 99)):
+    ' Nearest-rank percentiles of *samples*, or None if there are none '
+    if not samples:
+        return None
+    samples = sorted(samples)
+    result = dict(('p%d' % p, samples[max(0, -(-len(samples) * p // 100) - 1)]) for p in points)
+    result['max'] = samples[-1]
+    return result
+
+class WorkerStats(object):
+    ' Counters kept by one worker thread '
+    __slots__ = ('tasks', 'busy', 'idle')
+    def __init__(self):
+        self.tasks = 0
+        self.busy = 0.0
+        self.idle = 0.0
+
+class PoolStats(object):
+    '''
+    Timings collected by a ThreadPool created with stats=True. Each worker
+    writes only its own WorkerStats, and latencies and queue depths are kept
+    for the most recent *sample_size* work items or samples.
+    '''
+    def __init__(self, num, queue, sample_size):
+        self.workers = [WorkerStats() for _ in xrange(num)]
+        self.wait_times = collections.deque(maxlen=sample_size)
+        self.run_times = collections.deque(maxlen=sample_size)
+        self.queue_depths = collections.deque(maxlen=sample_size)
+        self._queue = queue
+
+    def sample_queue(self):
+        self.queue_depths.append((time.time(), self._queue.qsize()))
+
+    def snapshot(self):
+        self.sample_queue()
+        workers = [dict(tasks=w.tasks, busy=w.busy, idle=w.idle) for w in self.workers]
+        busy = sum(w['busy'] for w in workers)
+        idle = sum(w['idle'] for w in workers)
+        return dict(workers=workers,
+                    tasks=sum(w['tasks'] for w in workers),
+                    utilization=busy / (busy + idle) if busy + idle else 0.0,
+                    queue_depth=self.queue_depths[-1][1],
+                    queue_depths=list(self.queue_depths),
+                    wait=_percentiles(list(self.wait_times)),
+                    run=_percentiles(list(self.run_times)))
 
 class ThreadPool(object):
-    def __init__(self, num, func):
-        self._callable = callable
+    '''
+    Runs *func* on data push()ed or map()ped into the pool from *num* threads,
+    with results (or the exceptions raised) collected by iterating over the pool
+    once it is joined.
+
+    Arbitrary calls can also be submit()ted, returning a Future, and imap() and
+    imap_unordered() apply *func* to an iterable with a bounded number of chunks
+    in flight.
+
+    If *max_queued* is non-zero, it bounds the number of queued work items (each
+    a single push or a chunk of map()) and pushing blocks while the queue is
+    full. Don't push more than that before start().
+
+    If *stats* is True, the pool records per-worker task counts and busy and
+    idle time, queue depth and the wait and run latency of each work item,
+    available from stats(). Every *stats_interval* seconds the queue depth is
+    sampled and, if given, stats_callback(pool.stats()) is called from a
+    background thread. Without *stats* the workers do no timing at all.
+    '''
+    def __init__(self, num, func=None, max_queued=0, stats=False, stats_callback=None,
+                 stats_interval=1.0, stats_sample_size=10000):
+        self._func = func
         self._threads = []
-        self._inqueue = Queue.Queue()
+        self._inqueue = Queue.Queue(maxsize=max_queued)
         self._outqueue = Queue.Queue()
-        for _ in xrange(num):
-            self._threads.append(threading.Thread(target=runner, args=(self._inqueue, self._outqueue, func)))
-    
+        self._stats = None
+        if stats:
+            self._stats = PoolStats(num, self._inqueue, stats_sample_size)
+            self._stats_callback = stats_callback
+            self._stats_interval = stats_interval
+            self._stats_stop = threading.Event()
+            self._put = self._put_timed
+            for worker in self._stats.workers:
+                self._threads.append(threading.Thread(target=instrumented_runner,
+                        args=(self._inqueue, self._outqueue, worker, self._stats)))
+        else:
+            self._put = self._inqueue.put
+            for _ in xrange(num):
+                self._threads.append(threading.Thread(target=runner, args=(self._inqueue, self._outqueue)))
+
+    def _put_timed(self, batch):
+        self._inqueue.put((time.time(), batch))
+
+    def _report(self):
+        while not self._stats_stop.wait(self._stats_interval):
+            if self._stats_callback is not None:
+                self._stats_callback(self.stats())
+            else:
+                self._stats.sample_queue()
+
+    def stats(self):
+        '''
+        Returns a snapshot dict with per-worker counters (\'workers\'), totals
+        (\'tasks\', \'utilization\'), the current and sampled queue depths and
+        percentiles of the recent wait and run latencies in seconds.
+        '''
+        if self._stats is None:
+            raise ValueError('ThreadPool was created without stats=True')
+        return self._stats.snapshot()
+
     def __iter__(self): return self
     def next(self):
+        ' Returns a finished result, raising StopIteration if none is ready right now '
         try:
             return self._outqueue.get(block=False)
         except Queue.Empty:
             raise StopIteration
-    
+
     def push(self, data):
-        self._inqueue.put(data)
-    
+        self._put([(None, self._func, (data,), {})])
+
     def join(self):
-        [self.push(STOP) for _ in self._threads]
+        [self._inqueue.put(STOP) for _ in self._threads]
         [thread.join() for thread in self._threads]
-    
-    def map(self, iterable):
-        [self._inqueue.put(i) for i in iterable]
-    
+        if self._stats is not None:
+            self._stats_stop.set()
+
+    def map(self, iterable, chunksize=1):
+        ' push() each value of *iterable*, *chunksize* values per queue operation '
+        func = self._func
+        for chunk in chunks(chunksize, iterable):
+            self._put([(None, func, (data,), {}) for data in chunk])
+
+    def submit(self, fn, *args, **kwargs):
+        ' Schedules fn(*args, **kwargs) and returns a Future for its result '
+        future = Future()
+        self._put([(future, fn, args, kwargs)])
+        return future
+
+    def _submit_chunks(self, iterable, chunksize):
+        func = self._func
+        for chunk in chunks(chunksize, iterable):
+            yield self.submit(_map_chunk, func, chunk)
+
+    def _window(self, window):
+        return window if window is not None else 2 * len(self._threads)
+
+    def imap(self, iterable, window=None, chunksize=1):
+        '''
+        Yields func(value) for each value in *iterable*, in order. At most
+        *window* chunks of *chunksize* values (default: twice the number of
+        threads) are in flight, so *iterable* is consumed lazily. An exception
+        raised by func is re-raised here, and the remaining chunks are cancelled.
+        '''
+        window = self._window(window)
+        pending = collections.deque()
+        try:
+            for future in self._submit_chunks(iterable, chunksize):
+                pending.append(future)
+                if len(pending) >= window:
+                    for result in pending.popleft().result():
+                        yield result
+            while pending:
+                for result in pending.popleft().result():
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def imap_unordered(self, iterable, window=None, chunksize=1):
+        ' Like imap(), but yields results in the order chunks finish '
+        window = self._window(window)
+        done = Queue.Queue()
+        pending = set()
+        def finished():
+            future = done.get()
+            pending.discard(future)
+            return future.result()
+        try:
+            for future in self._submit_chunks(iterable, chunksize):
+                pending.add(future)
+                future.add_done_callback(done.put)
+                if len(pending) >= window:
+                    for result in finished():
+                        yield result
+            while pending:
+                for result in finished():
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
     def start(self):
         for thread in self._threads:
             thread.start()
-    
+        if self._stats is not None:
+            reporter = threading.Thread(target=self._report)
+            reporter.daemon = True
+            reporter.start()
+
 def myprint(data): print data # print is a statement...
 
 if __name__ == '__main__':
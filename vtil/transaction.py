@@ -1,6 +1,14 @@
-import os
 import shutil
-from cStringIO import StringIO
+import tempfile
+
+MEG = 2**20
+DEFAULT_SPILL_SIZE = 16 * MEG
+
+class Savepoint(object):
+    ' A point within a transaction that TransactionWriter.rollback() can return to '
+    __slots__ = ('pos',)
+    def __init__(self, pos):
+        self.pos = pos
 
 class TransactionWriter(object):
     '''
@@ -23,20 +31,68 @@ class TransactionWriter(object):
             writer.commit()
             writer.write('xyz')
         sio.getvalue() # '78abc'
+        with writer:
+            writer.write('123')
+            sp = writer.savepoint()
+            writer.write('456')
+            writer.rollback(sp) # undo writes since sp
+            writer.commit()
+        sio.getvalue() # '78abc123'
+
+    Transaction data is held in memory up to *spill_size* bytes and in a
+    temporary file beyond that, and commit() streams it to file_obj.
+
+    Savepoints nest: rolling back to one discards the savepoints taken after
+    it (but keeps it), and rollback() with no savepoint undoes all uncommitted
+    writes.
     '''
-    def __init__(self, file_obj):
+    def __init__(self, file_obj, spill_size=DEFAULT_SPILL_SIZE):
         self._file_obj = file_obj
+        self._spill_size = spill_size
         self._txnbuffer = None
+        self._savepoints = []
     
     def __enter__(self):
-        self._txnbuffer = StringIO()
+        self._txnbuffer = tempfile.SpooledTemporaryFile(max_size=self._spill_size)
     def __exit__(self, et, ev, tb):
+        self._txnbuffer.close()
         self._txnbuffer = None
+        self._savepoints = []
         return False
 
     def commit(self):
-        self._file_obj.write(self._txnbuffer.getvalue())
-        self._txnbuffer = StringIO()
+        self._txnbuffer.seek(0)
+        shutil.copyfileobj(self._txnbuffer, self._file_obj)
+        self._txnbuffer.seek(0)
+        self._txnbuffer.truncate()
+        self._savepoints = []
+
+    def savepoint(self):
+        ' Returns a Savepoint marking the current point in the transaction '
+        sp = Savepoint(self._txnbuffer.tell())
+        self._savepoints.append(sp)
+        return sp
+
+    def _find(self, sp):
+        for i, s in enumerate(self._savepoints):
+            if s is sp:
+                return i
+        raise ValueError('savepoint was released, rolled back past or committed')
+
+    def rollback(self, sp=None):
+        ' Undo writes made since *sp* (or since the last commit) '
+        if sp is None:
+            del self._savepoints[:]
+            pos = 0
+        else:
+            del self._savepoints[self._find(sp)+1:]
+            pos = sp.pos
+        self._txnbuffer.seek(pos)
+        self._txnbuffer.truncate()
+
+    def release(self, sp):
+        ' Forget *sp* and the savepoints taken after it, keeping their writes '
+        del self._savepoints[self._find(sp):]
     
     def write(self, data):
         if self._txnbuffer is not None:
@@ -45,6 +101,7 @@ class TransactionWriter(object):
             self._file_obj.write(data)
     
     def mem_use(self):
+        ' Returns the size of the uncommitted data (whether in memory or spilled) '
         return self._txnbuffer.tell() if self._txnbuffer is not None else 0
 
 class TransactionReader(object):
@@ -69,53 +126,83 @@ class TransactionReader(object):
             data7 = reader.read(2) # '78'
         with reader:
             data8 = reader.read(2) # '78'
+
+    Data is buffered in a bytearray. Committed data is only dropped once it
+    makes up most of the buffer, so commits take amortized constant time.
     '''
+    compact_size = 2**16 # least committed data worth dropping
+
     def __init__(self, file_obj):
         self._file_obj = file_obj
-        self._buffer = StringIO()
+        self._buffer = bytearray()
+        self._start = 0 # start of uncommitted data in _buffer
+        self._pos = 0 # read position in _buffer
     
     def __enter__(self): pass
     def __exit__(self, et, ev, tb):
         # cache un-committed data for later reads
-        self._buffer.seek(0, os.SEEK_SET)
+        self._pos = self._start
         return False
 
     def commit(self, n=None):
-        if n is not None:
-            pos = self._buffer.tell()
-            self._buffer.seek(n, os.SEEK_SET)
-        new_buffer = StringIO()
-        shutil.copyfileobj(self._buffer, new_buffer)
-        self._buffer = new_buffer
-        if n is not None:
-            new_buffer.seek(pos-n, os.SEEK_SET)
-
-    def _read_source(self, *args):
-        new_data = self._file_obj.read(*args)
-        self._buffer.write(new_data)
-        return new_data
+        ' Commit data read so far, or only the first *n* bytes of uncommitted data '
+        if n is None:
+            self._start = self._pos
+        else:
+            self._start = min(self._start + n, len(self._buffer))
+            self._pos = max(self._pos, self._start)
+        if self._start >= self.compact_size and self._start * 2 >= len(self._buffer):
+            del self._buffer[:self._start]
+            self._pos -= self._start
+            self._start = 0
+
+    def _fill(self, n):
+        ' Ensure n bytes are buffered past the read position, if the source has them '
+        missing = n - (len(self._buffer) - self._pos)
+        if missing > 0:
+            self._buffer.extend(self._file_obj.read(missing))
+
+    def _take(self, end):
+        # slicing a buffer() copies once, straight into a str
+        ret = buffer(self._buffer, self._pos, end - self._pos)[:]
+        self._pos = end
+        return ret
 
     def read(self, n=None):
+        if n is None or n < 0:
+            self._buffer.extend(self._file_obj.read())
+            return self._take(len(self._buffer))
+        else:
+            self._fill(n)
+            return self._take(min(self._pos + n, len(self._buffer)))
+
+    def readinto(self, b):
+        ' Read into the writable buffer *b*, returns the number of bytes read '
+        n = len(b)
+        self._fill(n)
+        n = min(n, len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def peek(self, n=None):
+        '''
+        Return up to *n* bytes past the read position (all buffered bytes if *n*
+        is not given) without consuming them. The result is a buffer() over the
+        internal buffer, valid until the next read or commit.
+        '''
         if n is None:
-            return self._buffer.read() + self._read_source()
+            n = len(self._buffer) - self._pos
         else:
-            ret = self._buffer.read(n)
-            if len(ret) < n:
-                ret += self._read_source(n-len(ret))
-            return ret
+            self._fill(n)
+        return buffer(self._buffer, self._pos, n)
 
     def readline(self):
-        data = self._buffer.readline()
-        if not data or data[-1] != '\n':
-            src_line = self._file_obj.readline()
-            self._buffer.write(src_line)
-            return data + src_line
-        else:
-            return data
+        end = self._buffer.find('\n', self._pos)
+        if end < 0:
+            self._buffer.extend(self._file_obj.readline())
+            end = self._buffer.find('\n', self._pos)
+        return self._take(end + 1 if end >= 0 else len(self._buffer))
 
     def mem_use(self):
-        pos = self._buffer.tell()
-        self._buffer.seek(0, os.SEEK_END)
-        size = self._buffer.tell()
-        self._buffer.seek(pos, os.SEEK_SET)
-        return size
+        return len(self._buffer) - self._start